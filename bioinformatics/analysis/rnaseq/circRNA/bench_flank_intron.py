@@ -0,0 +1,82 @@
+from __future__ import print_function
+from __future__ import division
+import time
+import click
+import numpy as np
+import pandas as pd
+from circexplore_summary import circ_flank_intron
+
+
+def legacy_flank_intron(circ_df):
+
+    def flankIntron2size(flankIntron, strand):
+        intron_list = flankIntron.split('|')
+        if len(intron_list) == 1:
+            return [np.nan, np.nan]
+        intron_cor_list = [each.split(':')[1].split('-')
+                           if each != 'None'
+                           else np.nan
+                           for each in intron_list]
+        intron_size = [int(each[1]) - int(each[0])
+                       if isinstance(each, list)
+                       else each
+                       for each in intron_cor_list]
+        if strand == '-':
+            intron_size = intron_size[::-1]
+        return intron_size
+    tmp = list(map(flankIntron2size,
+                   circ_df.flankIntron,
+                   circ_df.strand))
+    circ_df.loc[:, 'flankIntronSizeUP'] = [each[0] for each in tmp]
+    circ_df.loc[:, 'flankIntronSizeDOWN'] = [each[1] for each in tmp]
+    return circ_df
+
+
+def fake_flank_intron(row_num, seed=0):
+    rng = np.random.default_rng(seed)
+    start = rng.integers(10 ** 4, 10 ** 8, row_num)
+    end = start + rng.integers(200, 10 ** 5, row_num)
+    up_start = (start - rng.integers(10, 10 ** 4, row_num)).astype(str)
+    down_end = (end + rng.integers(10, 10 ** 4, row_num)).astype(str)
+    start = start.astype(str)
+    end = end.astype(str)
+    up_intron = pd.Series(np.char.add(np.char.add(
+        np.char.add('1:', up_start), '-'), start))
+    down_intron = pd.Series(np.char.add(np.char.add(
+        np.char.add('1:', end), '-'), down_end))
+    intron_type = rng.integers(0, 10, row_num)
+    up_intron[intron_type == 0] = 'None'
+    flank_intron = up_intron + '|' + down_intron
+    flank_intron[intron_type == 1] = up_intron[intron_type == 1]
+    return pd.DataFrame({
+        'flankIntron': flank_intron,
+        'strand': rng.choice(['+', '-'], row_num),
+    })
+
+
+@click.command()
+@click.option('--row_num', default=3000000, type=click.INT)
+def main(row_num):
+    '''
+    time per-row flankIntron parsing against the vectorized parser
+    '''
+    circ_df = fake_flank_intron(row_num)
+
+    start = time.perf_counter()
+    legacy_df = legacy_flank_intron(circ_df.copy())
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vector_df = circ_flank_intron(circ_df.copy())
+    vector_time = time.perf_counter() - start
+
+    for each_col in ('flankIntronSizeUP', 'flankIntronSizeDOWN'):
+        assert (legacy_df[each_col].fillna(-1).astype(int).values ==
+                vector_df[each_col].fillna(-1).astype(int).values).all()
+    print('rows: {n}'.format(n=row_num))
+    print('per-row parser: {t:.2f}s'.format(t=legacy_time))
+    print('vectorized parser: {t:.2f}s'.format(t=vector_time))
+
+
+if __name__ == '__main__':
+    main()
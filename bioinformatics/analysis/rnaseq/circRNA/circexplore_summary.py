@@ -1,11 +1,13 @@
 from __future__ import print_function
 from __future__ import division
 import pandas as pd
-import numpy as np
 import click
 import glob
+import io
+import json
 import os
-import sys
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
 
 
 READ_CUTOFF = 2
@@ -32,6 +34,59 @@ CIRC_HEADER = [
     'flankIntron'
 ]
 
+CIRC_DTYPES = {
+    'chrom': 'category',
+    'start': 'int64',
+    'end': 'int64',
+    'name': str,
+    'score': 'int32',
+    'strand': 'category',
+    'thickStart': 'int64',
+    'thickEnd': 'int64',
+    'itemRgb': 'category',
+    'exonCount': 'int32',
+    'exonSizes': str,
+    'exonOffsets': str,
+    'readNumber': 'int32',
+    'circType': 'category',
+    'geneName': 'category',
+    'isoformName': str,
+    'index': str,
+    'flankIntron': str,
+}
+
+CIRC_CATEGORY_COLS = [each for each in CIRC_DTYPES
+                      if CIRC_DTYPES[each] == 'category']
+
+FLANK_INTRON_COLS = list(range(6))
+FLANK_INTRON_TRANS = str.maketrans(':-|', '\t\t\t')
+
+STATS_COLS = [
+    'chrom',
+    'start',
+    'end',
+    'circType',
+    'exonSizes',
+    'exonCount',
+    'transcript_biotype',
+    'geneName',
+    'flankIntronSizeUP',
+    'flankIntronSizeDOWN'
+]
+
+MEAN_STATS_COLS = [
+    'exonCount',
+    'length',
+    'flankIntronSizeUP',
+    'flankIntronSizeDOWN'
+]
+
+STATS_OUT_COLS = ['number'] + MEAN_STATS_COLS + ['hostGene', 'readNumber']
+
+CIRC_CACHE = 'circ.combined.feather'
+CIRC_CACHE_SIG = 'circ.combined.sig.json'
+SUMMARY_STATE_DIR = '.summary_state'
+
 
 OUT_COL = [
     'circ_name',
@@ -89,63 +144,134 @@ SP_EN_NAME = {
 }
 
 
-def read_circ_table(circ_dir, suffix='circularRNA_known.txt'):
-    circ_tables = glob.glob('{d}/*{s}'.format(d=circ_dir, s=suffix))
-    circ_df_list = list()
-    for each_file in circ_tables:
-        each_df = pd.read_table(each_file, header=None, names=CIRC_HEADER)
-        sp_name = os.path.basename(each_file).split('.')[0]
-        each_df.loc[:, 'sample_id'] = sp_name
-        circ_df_list.append(each_df)
-    circ_df = pd.concat(circ_df_list)
+def circ_table_sample(circ_file):
+    return os.path.basename(circ_file).split('.')[0]
+
+
+def read_one_circ_table(circ_file):
+    circ_df = pd.read_table(circ_file, header=None, names=CIRC_HEADER,
+                            dtype=CIRC_DTYPES)
+    circ_df.loc[:, 'sample_id'] = circ_table_sample(circ_file)
+    return circ_df
+
+
+def file_signature(file_path):
+    file_stat = os.stat(file_path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def circ_table_signature(circ_tables):
+    return {os.path.basename(each): file_signature(each)
+            for each in circ_tables}
+
+
+def list_circ_tables(circ_dir, suffix='circularRNA_known.txt'):
+    return sorted(glob.glob('{d}/*{s}'.format(d=circ_dir, s=suffix)))
+
+
+def read_circ_table(circ_dir, suffix='circularRNA_known.txt', workers=4):
+    """
+    read CIRCexplorer tables of all samples in a process pool,
+    combined table is cached as feather, when tables are added,
+    removed or changed only those are read again and rows of the
+    other samples are taken from the cache.
+    """
+    circ_tables = list_circ_tables(circ_dir, suffix)
+    cache_file = os.path.join(circ_dir, CIRC_CACHE)
+    sig_file = os.path.join(circ_dir, CIRC_CACHE_SIG)
+    circ_sig = circ_table_signature(circ_tables)
+    cached_sig = {}
+    if os.path.isfile(cache_file) and os.path.isfile(sig_file):
+        with open(sig_file) as sig_inf:
+            cached_sig = json.load(sig_inf)
+        if cached_sig == circ_sig:
+            return pd.read_feather(cache_file)
+    # cache written by an older version, read everything again
+    if not isinstance(cached_sig, dict):
+        cached_sig = {}
+    kept_tables = [each for each in circ_tables
+                   if cached_sig.get(os.path.basename(each)) ==
+                   circ_sig[os.path.basename(each)]]
+    new_tables = [each for each in circ_tables if each not in kept_tables]
+    circ_df_list = []
+    if kept_tables:
+        cached_df = pd.read_feather(cache_file)
+        kept_samples = [circ_table_sample(each) for each in kept_tables]
+        circ_df_list.append(
+            cached_df[cached_df.sample_id.isin(kept_samples)])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        circ_df_list.extend(pool.map(read_one_circ_table, new_tables))
+    circ_df = pd.concat(circ_df_list, ignore_index=True)
+    if kept_tables:
+        # rows in file order, as if all tables were read again
+        sample_order = {circ_table_sample(each): order
+                        for order, each in enumerate(circ_tables)}
+        row_order = circ_df.sample_id.map(sample_order).argsort(
+            kind='mergesort')
+        circ_df = circ_df.iloc[row_order.values].reset_index(drop=True)
+    # categories differ between samples, unify them after concat
+    circ_df = circ_df.astype(
+        {each: 'category' for each in CIRC_CATEGORY_COLS})
+    circ_df.to_feather(cache_file)
+    with open(sig_file, 'w') as sig_out:
+        json.dump(circ_sig, sig_out)
     return circ_df
 
 
-def get_circ_stat(stats_df, col_name, method='mean'):
-    all_num = stats_df.loc[:, col_name].apply(method)
-    by_tr_type = stats_df.groupby(
-        ['transcript_biotype']).agg({col_name: method})
-    by_tr_type.loc['Total', col_name] = all_num
-    return by_tr_type
-
-
-def get_circ_num(stats_df):
-    all_num = pd.Series(len(stats_df), index=['Total'])
-    by_tr_type = stats_df.transcript_biotype.value_counts()
-    # circ_gene_type_num = stats_df.groupby(['gene_biotype', 'circType']).size()
-    # circ_gene_type_num.name = 'circ_count'
-    # circ_gene_type_num = circ_gene_type_num.reset_index()
-    # circ_gene_type_num.loc[:, 'name'] = circ_gene_type_num.circType + \
-    #     '-' + circ_gene_type_num.gene_biotype
-    # by_gene_circ_type = pd.Series(
-    #     circ_gene_type_num.circ_count.values, index=circ_gene_type_num.name)
-    circ_num_stats = pd.concat(
-        [all_num, by_tr_type]
-    )
-    circ_num_stats.name = 'number'
-    return circ_num_stats
-
-
-def get_host_gene_num(stats_df):
-    all_num = pd.Series(len(stats_df.geneName.unique()), index=['Total'])
-    ids_by_circ_type = stats_df.groupby('transcript_biotype')[
-        'geneName'].unique()
-    by_tr_type = pd.Series(map(len, ids_by_circ_type),
-                           index=ids_by_circ_type.index)
-    # circ_gene_type_num = stats_df.groupby(['gene_biotype', 'circType'])[
-    #     'geneName'].unique()
-    # num_by_gene_circ_type = map(len, circ_gene_type_num)
-    # circ_gene_type_num = circ_gene_type_num.reset_index()
-    # circ_gene_type_num.loc[:, 'name'] = circ_gene_type_num.circType + \
-    #     '-' + circ_gene_type_num.gene_biotype
-    # by_gene_circ_type = pd.Series(
-    #     num_by_gene_circ_type, index=circ_gene_type_num.name
-    # )
-    host_gene_stats = pd.concat(
-        [all_num, by_tr_type]
-    )
-    host_gene_stats.name = 'hostGene'
-    return host_gene_stats
+def get_circ_basic_stats(circ_type_df, by=None):
+    """
+    circRNA number, mean exonCount/length/flanking intron sizes,
+    host gene number and junction reads of each transcript biotype
+    and in Total.
+
+    with `by` (eg: sample_id) stats of every group are computed in the
+    same grouped aggregation, Total rows are rolled up from the biotype
+    sums and counts, so the cost does not grow with group number.
+    """
+    group_cols = [] if by is None else [by]
+    type_cols = group_cols + ['transcript_biotype']
+    stats_type_df = circ_type_df.loc[
+        :, group_cols + STATS_COLS].drop_duplicates()
+    stats_type_df.loc[:, 'length'] = stats_type_df.exonSizes.map(
+        exonSizes_to_len)
+    type_grouped = stats_type_df.groupby(type_cols, dropna=False)
+    type_sum_df = type_grouped[MEAN_STATS_COLS].sum().astype('float64')
+    type_count_df = type_grouped[MEAN_STATS_COLS].count()
+    type_stats_df = pd.concat(
+        [type_grouped.size().rename('number'),
+         type_sum_df.add_suffix('_sum'),
+         type_count_df.add_suffix('_count'),
+         circ_type_df.groupby(type_cols, dropna=False).readNumber.sum()],
+        axis=1)
+    if by is None:
+        total_stats_df = type_stats_df.sum().to_frame('Total').T
+        total_stats_df.loc[:, 'hostGene'] = stats_type_df.geneName.nunique()
+    else:
+        total_stats_df = type_stats_df.groupby(level=by).sum()
+        total_stats_df.loc[:, 'hostGene'] = stats_type_df.groupby(
+            by).geneName.nunique()
+        total_stats_df.loc[:, 'transcript_biotype'] = 'Total'
+        total_stats_df = total_stats_df.set_index(
+            'transcript_biotype', append=True)
+    type_stats_df.loc[:, 'hostGene'] = type_grouped.geneName.nunique()
+    # circRNAs without biotype only count in Total
+    type_stats_df = type_stats_df[
+        type_stats_df.index.get_level_values(-1).notna()]
+    type_stats_df = type_stats_df.sort_values(
+        group_cols + ['number'], ascending=[True] * len(group_cols) + [False],
+        kind='mergesort')
+    circ_merged_stats = pd.concat([total_stats_df, type_stats_df])
+    for each_col in MEAN_STATS_COLS:
+        circ_merged_stats.loc[:, each_col] = (
+            circ_merged_stats[each_col + '_sum'] /
+            circ_merged_stats[each_col + '_count'])
+    circ_merged_stats = circ_merged_stats.astype(
+        {'number': 'int64', 'hostGene': 'int64', 'readNumber': 'float64'})
+    circ_merged_stats = circ_merged_stats.loc[:, STATS_OUT_COLS]
+    circ_merged_stats.index.names = group_cols + ['Category']
+    if by is not None:
+        circ_merged_stats = circ_merged_stats.reset_index(by)
+    return circ_merged_stats
 
 
 def exonSizes_to_len(exonsizes):
@@ -154,51 +280,134 @@ def exonSizes_to_len(exonsizes):
 
 
 def circ_flank_intron(circ_df):
-
-    def flankIntron2size(flankIntron, strand):
-        # 1:7089216-7120193|1:7163371-7169514
-        intron_list = flankIntron.split('|')
-        if len(intron_list) == 1:
-            return [np.nan, np.nan]
-        try:
-            intron_cor_list = [each.split(':')[1].split('-')
-                               if each != 'None'
-                               else np.nan
-                               for each in intron_list]
-        except IndexError:
-            print(intron_list)
-            sys.exit(1)
-        try:
-            intron_size = [int(each[1]) - int(each[0])
-                           if isinstance(each, list)
-                           else each
-                           for each in intron_cor_list]
-        except TypeError:
-            print(intron_cor_list)
-            sys.exit(1)
-        if strand == '-':
-            intron_size = intron_size[::-1]
-        return intron_size
-    try:
-        tmp = map(flankIntron2size,
-                  circ_df.flankIntron,
-                  circ_df.strand)
-        circ_df.loc[:, 'flankIntronSizeUP'] = [each[0] for each
-                                               in tmp]
-        circ_df.loc[:, 'flankIntronSizeDOWN'] = [each[1] for each
-                                                 in tmp]
-        # circ_df.loc[:, 'flankIntronSize'] = tmp
-        # circ_df.loc[:, 'flankIntronSize'] = map(flankIntron2size,
-        #                                         circ_df.flankIntron,
-        #                                         circ_df.strand)
-    except ValueError:
-        print(len(circ_df.flankIntron), len(circ_df.strand), len(circ_df))
-        sys.exit(1)
+    """
+    flanking intron sizes from flankIntron column, eg:
+    1:7089216-7120193|1:7163371-7169514 (None for a missing side),
+    upstream/downstream are swapped for circRNAs on minus strand.
+
+    all rows are tokenized in one pass by the C csv parser:
+    'None' is padded to three fields and ':', '-', '|' become tabs.
+    """
+    flank_text = '\n'.join(circ_df.flankIntron.astype(str))
+    flank_text = flank_text.replace('None', 'None\t\t').translate(
+        FLANK_INTRON_TRANS)
+    intron_cor = pd.read_csv(io.StringIO(flank_text), sep='\t',
+                             header=None, names=FLANK_INTRON_COLS,
+                             usecols=[1, 2, 3, 4, 5],
+                             dtype={3: str}, skip_blank_lines=False)
+    # only a pair of flanking introns is informative
+    no_pair = intron_cor[3].isna().values
+    left_size = (intron_cor[2] - intron_cor[1]).astype('Int64')
+    right_size = (intron_cor[5] - intron_cor[4]).astype('Int64')
+    left_size[no_pair] = pd.NA
+    right_size[no_pair] = pd.NA
+    is_minus = (circ_df.strand == '-').values
+    circ_df.loc[:, 'flankIntronSizeUP'] = left_size.where(
+        ~is_minus, right_size).values
+    circ_df.loc[:, 'flankIntronSizeDOWN'] = right_size.where(
+        ~is_minus, left_size).values
     return circ_df
-    # circ_df.loc[:, 'flankIntronSizeUP'] = [each[0] for each
-    #                                        in circ_df.flankIntronSize]
-    # circ_df.loc[:, 'flankIntronSizeDOWN'] = [each[1] for each
-    #                                          in circ_df.flankIntronSize]
+
+
+def build_circ_matrix(circ_name_df):
+    """
+    circRNA x sample readNumber matrix in CSR format,
+    rows are unique circRNA annotations in sorted order, which are
+    returned separately to be joined only when writing tables.
+    """
+    meta_cols = OUT_COL[:-2]
+    row_code = circ_name_df.groupby(
+        meta_cols, dropna=False, observed=True, sort=True).ngroup().values
+    col_code, samples = pd.factorize(circ_name_df.sample_id, sort=True)
+    # a sample listed in more than one tissue is counted once
+    code_df = pd.DataFrame({'row': row_code, 'col': col_code,
+                            'readNumber': circ_name_df.readNumber.values})
+    code_df = code_df.drop_duplicates(['row', 'col'])
+    meta_df = circ_name_df.loc[:, meta_cols]
+    meta_df.loc[:, 'row'] = row_code
+    meta_df = meta_df.drop_duplicates('row').sort_values('row')
+    meta_df = meta_df.drop('row', axis=1).reset_index(drop=True)
+    meta_df.columns = OUT_COL_NAME[:-2]
+    circ_mat = sparse.coo_matrix(
+        (code_df.readNumber.values, (code_df.row.values, code_df.col.values)),
+        shape=(len(meta_df), len(samples))).tocsr()
+    return circ_mat, meta_df, pd.Index(samples)
+
+
+def get_circ_exp_df(circ_mat, meta_df, samples, out_samples=None):
+    """
+    circRNA table of selected samples, only circRNAs detected in
+    any of them are kept.
+    """
+    if out_samples is None:
+        out_samples = list(samples)
+    out_mat = circ_mat[:, samples.get_indexer(out_samples)]
+    is_detected = out_mat.getnnz(axis=1) > 0
+    exp_df = pd.DataFrame(out_mat[is_detected].toarray(),
+                          columns=out_samples)
+    return pd.concat([meta_df[is_detected].reset_index(drop=True), exp_df],
+                     axis=1)
+
+
+def fillna_none(out_df):
+    """
+    fill missing values with 'None', nullable integer columns
+    can not hold a string so they are turned into object first.
+    """
+    int_cols = [each for each in out_df.columns
+                if pd.api.types.is_extension_array_dtype(out_df[each]) and
+                pd.api.types.is_integer_dtype(out_df[each])]
+    out_df = out_df.astype({each: object for each in int_cols})
+    return out_df.fillna('None')
+
+
+def get_circ_name(circ_tissue_type_df, abbr, registry_file=None):
+    """
+    name circRNAs as {abbr}_circ_{num:0>6} in order of position.
+
+    with `registry_file`, numbers given in previous runs are kept and
+    new circRNAs are numbered after the largest one, so IDs are stable
+    when samples are added. circRNAs only found in removed samples
+    stay in the registry and their numbers are not reused.
+    """
+    circ_name = circ_tissue_type_df.groupby(['chrom', 'start', 'end'],
+                                            observed=True).size()
+    circ_name.name = 'circ_count'
+    circ_name = circ_name.reset_index()
+    circ_pos_df = circ_name.loc[:, ['chrom', 'start', 'end']].astype(
+        {'chrom': str})
+    registry_df = circ_pos_df.iloc[:0].assign(circ_num=0, circ_name='')
+    if registry_file is not None and os.path.isfile(registry_file):
+        registry_df = pd.read_table(registry_file, dtype={'chrom': str})
+    circ_num = pd.merge(circ_pos_df, registry_df.iloc[:, :4],
+                        how='left').circ_num
+    is_new = circ_num.isna().values
+    last_num = int(registry_df.circ_num.max()) if len(registry_df) else 0
+    circ_num[is_new] = range(last_num + 1, last_num + 1 + is_new.sum())
+    circ_name.loc[:, 'circ_name'] = [
+        '{sp}_circ_{num:0>6}'.format(sp=abbr, num=each)
+        for each in circ_num.astype('int64')]
+    if registry_file is not None:
+        circ_pos_df.loc[:, 'circ_num'] = circ_num.astype('int64').values
+        circ_pos_df.loc[:, 'circ_name'] = circ_name.circ_name.values
+        registry_df = pd.concat([registry_df, circ_pos_df[is_new]])
+        registry_df = registry_df.sort_values('circ_num')
+        registry_df.to_csv(registry_file + '.tmp', sep='\t', index=False)
+        os.replace(registry_file + '.tmp', registry_file)
+    return circ_name
+
+
+def load_summary_state(state_file):
+    if os.path.isfile(state_file):
+        with open(state_file) as state_inf:
+            return json.load(state_inf)
+    return {}
+
+
+def save_summary_state(state, state_file):
+    with open(state_file + '.tmp', 'w') as state_out:
+        json.dump(state, state_out)
+    os.replace(state_file + '.tmp', state_file)
 
 
 @click.command()
@@ -258,19 +467,61 @@ def circ_flank_intron(circ_df):
     default=None,
     help='supplementary information to add to the end of output.'
 )
+@click.option(
+    '-p',
+    '--workers',
+    type=click.INT,
+    default=4,
+    help='number of processes to read circRNA tables.'
+)
+@click.option(
+    '--incremental',
+    is_flag=True,
+    help='keep circRNA IDs stable across runs and only rewrite '
+    'tables of tissues with added, removed or changed samples.'
+)
 def main(circ_dir, gene_type, out_dir, species, exp_table,
          tissue_sample, mapping_summary, circ_type, abbr,
-         sup):
+         sup, workers, incremental):
     # make sure output dir exists
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
     sp_en_name = SP_EN_NAME[species]
-    combined_circ_out = os.path.join(circ_dir, 'circ.combined.txt')
-    if not os.path.isfile(combined_circ_out):
-        circ_df = read_circ_table(circ_dir)
-        circ_df.to_csv(combined_circ_out, index=False, sep='\t')
-    else:
-        circ_df = pd.read_table(combined_circ_out)
+    circ_df = read_circ_table(circ_dir, workers=workers)
+
+    # state of last incremental run, reset when shared inputs change
+    registry_file = None
+    state = {}
+    changed_samples = set()
+    if incremental:
+        state_dir = os.path.join(out_dir, SUMMARY_STATE_DIR)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        registry_file = os.path.join(
+            state_dir, '{a}.{t}.registry.txt'.format(a=abbr, t=circ_type))
+        state_file = os.path.join(
+            state_dir, '{t}.state.json'.format(t=circ_type))
+        partial_file = os.path.join(
+            state_dir, '{t}.sample_stats.feather'.format(t=circ_type))
+        inputs_sig = {
+            'species': species,
+            'abbr': abbr,
+            'read_cutoff': READ_CUTOFF,
+            'gene_type': file_signature(gene_type),
+            'sup': None if sup is None else file_signature(sup),
+        }
+        state = load_summary_state(state_file)
+        if state.get('inputs') != inputs_sig or not (
+                os.path.isfile(registry_file) and
+                os.path.isfile(partial_file)):
+            state = {}
+        sample_sig = {
+            circ_table_sample(each): each_sig for each, each_sig in
+            circ_table_signature(list_circ_tables(circ_dir)).items()}
+        last_sample_sig = state.get('samples', {})
+        changed_samples = {
+            each for each in set(sample_sig).union(last_sample_sig)
+            if sample_sig.get(each) != last_sample_sig.get(each)}
 
     circ_df = circ_df[circ_df.readNumber >= READ_CUTOFF]
     if circ_type != 'all_circ':
@@ -281,32 +532,6 @@ def main(circ_dir, gene_type, out_dir, species, exp_table,
                             how='left')
     circ_type_df = circ_flank_intron(circ_type_df)
 
-    def get_circ_basic_stats(circ_type_df):
-        stats_type_df = circ_type_df.loc[:, ['chrom', 'start', 'end',
-                                             'circType', 'exonSizes',
-                                             'exonCount', 'transcript_biotype',
-                                             'geneName', 'flankIntronSizeUP',
-                                             'flankIntronSizeDOWN']].drop_duplicates()
-        stats_type_df.loc[:, 'length'] = stats_type_df.exonSizes.map(
-            exonSizes_to_len)
-        circ_num_stats = get_circ_num(stats_type_df)
-        exon_stats = get_circ_stat(stats_type_df,
-                                   'exonCount')
-        circ_len_stats = get_circ_stat(stats_type_df,
-                                       'length')
-        f_intron_up_stats = get_circ_stat(stats_type_df,
-                                          'flankIntronSizeUP')
-        f_intron_down_stats = get_circ_stat(stats_type_df,
-                                            'flankIntronSizeDOWN')
-        host_gene_stats = get_host_gene_num(stats_type_df)
-        junc_reads_stats = get_circ_stat(circ_type_df,
-                                         'readNumber', 'sum')
-        circ_merged_stats = pd.concat(
-            [circ_num_stats, exon_stats, circ_len_stats,
-             f_intron_up_stats, f_intron_down_stats,
-             host_gene_stats, junc_reads_stats], axis=1)
-        circ_merged_stats.index.name = 'Category'
-        return circ_merged_stats
     circ_merged_stats = get_circ_basic_stats(circ_type_df)
     stats_out_file = os.path.join(out_dir, '{sp}.{t}.stats.txt'.format(
         t=circ_type,
@@ -317,13 +542,22 @@ def main(circ_dir, gene_type, out_dir, species, exp_table,
     # sample summary
     sample_stats_file = os.path.join(
         out_dir, '{t}.stats.sample.txt'.format(t=circ_type))
-    sample_stats_list = list()
-    for each_sample in circ_type_df.sample_id.unique():
-        each_sample_df = circ_type_df[circ_type_df.sample_id == each_sample]
-        each_sample_stats = get_circ_basic_stats(each_sample_df)
-        each_sample_stats.loc[:, 'sample_id'] = each_sample
-        sample_stats_list.append(each_sample_stats)
-    sample_df = pd.concat(sample_stats_list)
+    if state:
+        # per-sample stats are independent, only changed ones are redone
+        sample_df = pd.read_feather(partial_file)
+        sample_df = sample_df[sample_df.sample_id.isin(sample_sig) &
+                              ~sample_df.sample_id.isin(changed_samples)]
+        changed_type_df = circ_type_df[
+            circ_type_df.sample_id.isin(changed_samples)]
+        if len(changed_type_df):
+            sample_df = pd.concat([sample_df, get_circ_basic_stats(
+                changed_type_df, by='sample_id').reset_index()])
+        sample_df = sample_df.sort_values(
+            'sample_id', kind='mergesort').set_index('Category')
+    else:
+        sample_df = get_circ_basic_stats(circ_type_df, by='sample_id')
+    if incremental:
+        sample_df.reset_index().to_feather(partial_file)
     # sample_df = sample_df.reset_index().set_index(['sample_id', 'Category'])
     # sample_out_df = sample_df.unstack('Category')
 
@@ -391,34 +625,18 @@ def main(circ_dir, gene_type, out_dir, species, exp_table,
     # tissue circ_table
     circ_tissue_type_df = circ_tissue_type_df.sort_values(
         ['chrom', 'start', 'end'])
-    circ_name = circ_tissue_type_df.groupby(['chrom', 'start', 'end']).size()
-    circ_name.name = 'circ_count'
-    circ_name = circ_name.reset_index()
-    circ_name.loc[:, 'circ_name'] = [
-        '{sp}_circ_{num:0>6}'.format(sp=abbr,
-                                     num=each + 1)
-        for each in circ_name.index]
+    circ_name = get_circ_name(circ_tissue_type_df, abbr, registry_file)
     circ_name_df = pd.merge(circ_tissue_type_df, circ_name)
     circ_name_df.loc[:, 'length'] = circ_name_df.exonSizes.map(
         exonSizes_to_len)
     exp_table_df = pd.read_table(exp_table, index_col=0)
-
-    def get_circ_exp_df(circ_df):
-        each_tissue_df = circ_df.loc[:, OUT_COL]
-        each_tissue_df.columns = OUT_COL_NAME
-        each_tissue_df = each_tissue_df.set_index(OUT_COL_NAME[:-1])
-        each_tissue_out_df = each_tissue_df.unstack('sampleID')
-        each_tissue_out_df.columns = each_tissue_out_df.columns.droplevel()
-        each_tissue_out_df.columns.name = ''
-        each_tissue_out_df = each_tissue_out_df.fillna(0)
-        each_tissue_out_df = each_tissue_out_df.astype('int')
-        return each_tissue_out_df
+    circ_mat, circ_meta_df, circ_samples = build_circ_matrix(circ_name_df)
 
     def combine_gene_exp(circ_df, exp_table_df, samples):
         each_tissue_host_df = exp_table_df.loc[:, samples]
         each_tissue_host_df.columns = ['{cn}(host gene)'.format(cn=each)
                                        for each in each_tissue_host_df.columns]
-        each_tissue_out_df = pd.merge(circ_df.reset_index(),
+        each_tissue_out_df = pd.merge(circ_df,
                                       each_tissue_host_df,
                                       left_on='geneID', right_index=True,
                                       how='left')
@@ -427,18 +645,30 @@ def main(circ_dir, gene_type, out_dir, species, exp_table,
     if sup is not None:
         sup_df = pd.read_table(sup)
 
+    tissue_state = {}
     for each_tissue in tissue_sample_num.index:
-        each_tissue_df = circ_name_df[circ_name_df.tissue == each_tissue]
-        each_tissue_out_df = get_circ_exp_df(each_tissue_df)
         each_tissue_samples = sorted(tissue_df[tissue_df.tissue ==
                                                each_tissue].sample_id)
-        each_tissue_out_df = combine_gene_exp(
-            each_tissue_out_df, exp_table_df, each_tissue_samples)
         tissue_stats_file = os.path.join(
             out_dir, '{sp}.{ts}.{tp}.detail.txt'.format(tp=circ_type,
                                                         ts=each_tissue,
                                                         sp=sp_en_name))
-        each_tissue_out_df.fillna('None', inplace=True)
+        # unchanged samples and host gene expression, table is up to date
+        each_host_hash = pd.util.hash_pandas_object(
+            exp_table_df.loc[:, each_tissue_samples]).sum()
+        tissue_state[each_tissue] = {'samples': each_tissue_samples,
+                                     'host_exp': int(each_host_hash)}
+        if (state.get('tissues', {}).get(each_tissue) ==
+                tissue_state[each_tissue] and
+                not changed_samples.intersection(each_tissue_samples) and
+                os.path.isfile(tissue_stats_file)):
+            continue
+        each_tissue_out_df = get_circ_exp_df(
+            circ_mat, circ_meta_df, circ_samples,
+            [each for each in each_tissue_samples if each in circ_samples])
+        each_tissue_out_df = combine_gene_exp(
+            each_tissue_out_df, exp_table_df, each_tissue_samples)
+        each_tissue_out_df = fillna_none(each_tissue_out_df)
         if sup is not None:
             each_tissue_out_df = pd.merge(each_tissue_out_df, sup_df,
                                           how='left')
@@ -449,8 +679,8 @@ def main(circ_dir, gene_type, out_dir, species, exp_table,
     merged_out_file = os.path.join(
         out_dir, '{sp}.all_tissues.{tp}.detail.txt'.format(tp=circ_type,
                                                            sp=sp_en_name))
-    merged_out_df = get_circ_exp_df(circ_name_df)
-    samples = sorted(circ_name_df.sample_id.unique())
+    merged_out_df = get_circ_exp_df(circ_mat, circ_meta_df, circ_samples)
+    samples = list(circ_samples)
     merged_out_df = combine_gene_exp(merged_out_df, exp_table_df, samples)
     tissue_num_df = pd.DataFrame(
         circ_name_df.groupby('circ_name')['tissue'].unique())
@@ -462,7 +692,7 @@ def main(circ_dir, gene_type, out_dir, species, exp_table,
                              left_on='circRNAID',
                              right_index=True,
                              how='left')
-    merged_out_df.fillna('None', inplace=True)
+    merged_out_df = fillna_none(merged_out_df)
     merged_out_df.loc[:, 'species'] = sp_en_name
     if sup is not None:
         merged_out_df = pd.merge(merged_out_df, sup_df,
@@ -470,6 +700,10 @@ def main(circ_dir, gene_type, out_dir, species, exp_table,
         merged_out_df.fillna(0, inplace=True)
     merged_out_df.to_csv(merged_out_file, sep='\t',
                          index=False, float_format='%.3f')
+    if incremental:
+        save_summary_state({'inputs': inputs_sig,
+                            'samples': sample_sig,
+                            'tissues': tissue_state}, state_file)
 
 
 if __name__ == '__main__':
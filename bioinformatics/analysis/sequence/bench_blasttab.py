@@ -0,0 +1,74 @@
+import time
+import click
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from omblast import DEFAULT_HIT_FIELDS, best_hit, reciprocal_best_hit
+
+
+def fake_blasttab(outfile, query_num, hit_num, qpref, spref, seed=0):
+    rng = np.random.default_rng(seed)
+    line_num = query_num * hit_num
+    blast_df = pd.DataFrame({
+        'qseqid': np.repeat([f'{qpref}{i}' for i in range(query_num)],
+                            hit_num),
+        'sseqid': [f'{spref}{i}' for i in
+                   rng.integers(0, query_num, line_num)],
+        'pident': rng.uniform(30, 100, line_num).round(3),
+        'length': rng.integers(50, 500, line_num),
+        'mismatch': rng.integers(0, 50, line_num),
+        'gapopen': rng.integers(0, 5, line_num),
+        'qstart': 1,
+        'qend': 100,
+        'sstart': 1,
+        'send': 100,
+        'evalue': 1e-10,
+        'bitscore': rng.uniform(50, 500, line_num).round(1),
+    }, columns=DEFAULT_HIT_FIELDS)
+    blast_df.to_csv(outfile, sep='\t', header=False, index=False)
+
+
+def legacy_merge(blasttab1, blasttab2):
+    blast1_df = pd.read_csv(blasttab1,
+                            sep='\t',
+                            header=None,
+                            names=DEFAULT_HIT_FIELDS)
+    blast2_df = pd.read_csv(blasttab2,
+                            sep='\t',
+                            header=None,
+                            names=DEFAULT_HIT_FIELDS)
+    return blast1_df.merge(blast2_df,
+                           left_on=['qseqid', 'sseqid'],
+                           right_on=['sseqid', 'qseqid'])
+
+
+@click.command()
+@click.option('--query_num', default=200000, type=click.INT)
+@click.option('--hit_num', default=20, type=click.INT)
+@click.option('--outdir', default='.', type=click.Path(file_okay=False))
+def main(query_num, hit_num, outdir):
+    '''
+    time the old (qseqid, sseqid) merge against streaming best hit + RBH
+    '''
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    blasttab1 = outdir / 'bench.a_vs_b.blasttab'
+    blasttab2 = outdir / 'bench.b_vs_a.blasttab'
+    fake_blasttab(blasttab1, query_num, hit_num, 'a', 'b', seed=1)
+    fake_blasttab(blasttab2, query_num, hit_num, 'b', 'a', seed=2)
+
+    start = time.perf_counter()
+    legacy_df = legacy_merge(blasttab1, blasttab2)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rbh_df = reciprocal_best_hit(best_hit(blasttab1), best_hit(blasttab2))
+    rbh_time = time.perf_counter() - start
+
+    print(f'lines per file: {query_num * hit_num}')
+    print(f'legacy merge: {legacy_time:.2f}s, {len(legacy_df)} pairs')
+    print(f'streaming rbh: {rbh_time:.2f}s, {len(rbh_df)} pairs')
+
+
+if __name__ == '__main__':
+    main()
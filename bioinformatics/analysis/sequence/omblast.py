@@ -1,13 +1,17 @@
 import attr
+import json
 import click
 import shutil
+import hashlib
 import delegator
-import itertools
 import click_completion
 import pandas as pd
-from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from loguru import logger
 from pathlib import Path
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
+from seq_sniff import sniff_fasta
 
 click_completion.init()
 CURRENT_DIR = Path().cwd()
@@ -21,6 +25,10 @@ class BlastNotFound(Exception):
     pass
 
 
+class BlastRunError(Exception):
+    pass
+
+
 DB_SUFFIX_DICT = {
     'nucl': set(['.nin', '.nsq', '.nhr']),
     'prot': set(['.pin', '.psq', '.phr']),
@@ -48,42 +56,210 @@ DEFAULT_HIT_FIELDS = [
     'bitscore',
 ]
 
+# subject ids are too diverse within a chunk to gain from category
+BLAST_TAB_DTYPES = {
+    'qseqid': 'category',
+    'sseqid': str,
+    'pident': 'float32',
+    'length': 'int32',
+    'mismatch': 'int32',
+    'gapopen': 'int32',
+    'qstart': 'int32',
+    'qend': 'int32',
+    'sstart': 'int32',
+    'send': 'int32',
+    'evalue': 'float64',
+    'bitscore': 'float32',
+}
 
-def is_prot(seq_record):
-    nucl_set = {'A', 'T', 'G', 'C', 'N'}
-    seq_set = {seq_i for seq_i in seq_record.seq.upper() if seq_i.isalpha()}
-    if seq_set.difference(nucl_set):
-        return True
-    return False
+BLAST_TAB_CHUNKSIZE = 1000000
+
+
+def blast_db_type(db_file):
+    suffix_set = set()
+    for file_i in db_file.parent.glob(f'{db_file.name}.*'):
+        suffix_set.add(file_i.suffix)
+    for dtype in DB_SUFFIX_DICT:
+        if len(suffix_set.intersection(DB_SUFFIX_DICT[dtype])) == 3:
+            return dtype
+    return None
+
+
+def file_digest(file_path, cache_dir):
+    '''
+    sha1 of file content, remembered in cache_dir by path, size and mtime
+    so an unchanged file is hashed only once.
+    '''
+    file_path = Path(file_path).resolve()
+    file_stat = file_path.stat()
+    file_sig = [file_stat.st_size, file_stat.st_mtime_ns]
+    index_file = cache_dir / 'digest_index.json'
+    if index_file.exists():
+        digest_index = json.loads(index_file.read_text())
+    else:
+        digest_index = {}
+    file_key = str(file_path)
+    if digest_index.get(file_key, {}).get('sig') == file_sig:
+        return digest_index[file_key]['digest']
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as file_inf:
+        for block in iter(lambda: file_inf.read(1 << 20), b''):
+            file_hash.update(block)
+    fa_digest = file_hash.hexdigest()
+    digest_index[file_key] = {'sig': file_sig, 'digest': fa_digest}
+    tmp_index = index_file.with_suffix(f'.{fa_digest}.tmp')
+    tmp_index.write_text(json.dumps(digest_index))
+    tmp_index.replace(index_file)
+    return fa_digest
+
+
+def db_signature(db_file):
+    '''
+    signature of blast database files by name, size and mtime
+    '''
+    db_hash = hashlib.sha1()
+    for file_i in sorted(db_file.parent.glob(f'{db_file.name}.*')):
+        if file_i.suffix in ('.fasta', '.sig', '.tmp'):
+            continue
+        file_stat = file_i.stat()
+        file_sig = f'{file_i.name}:{file_stat.st_size}:{file_stat.st_mtime_ns}'
+        db_hash.update(file_sig.encode())
+    return db_hash.hexdigest()
+
+
+def split_fasta(fasta, chunks, chunk_dir, blast_sig=None):
+    '''
+    split fasta into at most `chunks` files with balanced residue length,
+    sequence order is kept so chunk outputs can be merged in query order.
+    a finished split and its chunk outputs are reused while the fasta,
+    `chunks` and `blast_sig` (blast command and database) are unchanged.
+    '''
+    chunk_dir.mkdir(parents=True, exist_ok=True)
+    done_flag = chunk_dir / '.split.done'
+    fasta_stat = Path(fasta).stat()
+    split_sig = {'fasta': str(Path(fasta).resolve()),
+                 'sig': [fasta_stat.st_size, fasta_stat.st_mtime_ns],
+                 'chunks': chunks,
+                 'blast': blast_sig}
+    if done_flag.exists():
+        if json.loads(done_flag.read_text() or '{}') == split_sig:
+            return sorted(chunk_dir.glob('chunk_*.fa'))
+        # query, chunks or blast run changed, old chunks and outputs
+        # are stale
+        done_flag.unlink()
+    for stale_file in chunk_dir.glob('chunk_*'):
+        stale_file.unlink()
+    with open(fasta) as fasta_inf:
+        total_len = sum(len(seq) for _, seq in SimpleFastaParser(fasta_inf))
+    chunk_len = max(total_len / chunks, 1)
+    chunk_files = []
+    chunk_inf = None
+    cum_len = 0
+    with open(fasta) as fasta_inf:
+        for title, seq in SimpleFastaParser(fasta_inf):
+            chunk_idx = min(int(cum_len // chunk_len), chunks - 1)
+            if chunk_idx >= len(chunk_files):
+                if chunk_inf is not None:
+                    chunk_inf.close()
+                chunk_file = chunk_dir / f'chunk_{len(chunk_files):0>4}.fa'
+                chunk_files.append(chunk_file)
+                chunk_inf = open(chunk_file, 'w')
+            chunk_inf.write(f'>{title}\n{seq}\n')
+            cum_len += len(seq)
+    if chunk_inf is not None:
+        chunk_inf.close()
+    done_flag.write_text(json.dumps(split_sig))
+    return chunk_files
+
+
+def run_blast_chunk(blast_cmd, chunk_out):
+    '''
+    run one blast chunk, output is renamed in place only when blast succeeds
+    so an existing chunk output always means a finished chunk.
+    '''
+    tmp_out = chunk_out.with_suffix('.tmp')
+    blast_proc = delegator.run(f'{blast_cmd} -out {tmp_out}')
+    if blast_proc.return_code != 0:
+        raise BlastRunError(f'{chunk_out.name} failed: {blast_proc.err}')
+    tmp_out.rename(chunk_out)
+    return chunk_out
+
+
+def merge_blast_chunks(chunk_outs, blastout_file):
+    with open(blastout_file, 'wb') as blastout_inf:
+        for chunk_out in chunk_outs:
+            with open(chunk_out, 'rb') as chunk_inf:
+                shutil.copyfileobj(chunk_inf, blastout_inf)
+
+
+def read_blasttab(blasttab, chunksize=BLAST_TAB_CHUNKSIZE, usecols=None):
+    """
+    iterate blast tabular output in chunks with compact dtypes
+    """
+    return pd.read_csv(blasttab,
+                       sep='\t',
+                       header=None,
+                       names=DEFAULT_HIT_FIELDS,
+                       usecols=usecols,
+                       dtype=BLAST_TAB_DTYPES,
+                       chunksize=chunksize)
 
 
 def filter_by_identity(blasttab, identity):
-    blast_df = pd.read_csv(blasttab,
-                           sep='\t',
-                           header=None,
-                           names=DEFAULT_HIT_FIELDS)
-    f_blast_df = blast_df[blast_df.pident >= identity]
     f_blast_file = blasttab.with_suffix(f'.pident{identity}.blasttab')
-    f_blast_df.to_csv(f_blast_file, sep='\t', header=False, index=False)
+    with open(f_blast_file, 'w') as f_blast_inf:
+        for blast_df in read_blasttab(blasttab):
+            f_blast_df = blast_df[blast_df.pident >= identity]
+            f_blast_df.to_csv(f_blast_inf, sep='\t', header=False,
+                              index=False)
     return f_blast_file
 
 
+def best_hit(blasttab, chunksize=BLAST_TAB_CHUNKSIZE):
+    """
+    best hit (highest bitscore, first in file on ties) of each query,
+    memory is bounded by query number instead of blast output lines.
+    """
+    best_cols = ['qseqid', 'sseqid', 'pident', 'bitscore']
+    best_dfs = []
+    for blast_df in read_blasttab(blasttab, chunksize=chunksize,
+                                  usecols=best_cols):
+        chunk_best_df = blast_df.sort_values(
+            'bitscore', ascending=False, kind='mergesort').drop_duplicates(
+                'qseqid')
+        # category codes differ between chunks, compare ids as strings
+        chunk_best_df = chunk_best_df.astype({'qseqid': str})
+        best_dfs.append(chunk_best_df)
+        if len(best_dfs) > 1:
+            best_dfs = [
+                pd.concat(best_dfs).sort_values(
+                    'bitscore', ascending=False,
+                    kind='mergesort').drop_duplicates('qseqid')
+            ]
+    if not best_dfs:
+        return pd.DataFrame(columns=best_cols[1:],
+                            index=pd.Index([], name='qseqid'))
+    return best_dfs[0].set_index('qseqid')
+
+
+def reciprocal_best_hit(best_df1, best_df2):
+    """
+    pairs whose best hit in both directions point to each other,
+    lookups go through the hash index of query ids.
+    """
+    back_hit = best_df2.reindex(best_df1.sseqid.values)
+    is_rbh = back_hit.sseqid.values == best_df1.index.values
+    rbh_df = best_df1.loc[is_rbh, ['sseqid', 'pident']].reset_index()
+    rbh_df.columns = ['qseqid_x', 'sseqid_x', 'pident_x']
+    rbh_df.loc[:, 'pident_y'] = back_hit.pident.values[is_rbh]
+    return rbh_df
+
+
 def bidirectional_hit(blasttab1, blasttab2, outfile):
-    blast1_df = pd.read_csv(blasttab1,
-                            sep='\t',
-                            header=None,
-                            names=DEFAULT_HIT_FIELDS)
-    blast2_df = pd.read_csv(blasttab2,
-                            sep='\t',
-                            header=None,
-                            names=DEFAULT_HIT_FIELDS)
-    bbh_df = blast1_df.merge(blast2_df,
-                             left_on=['qseqid', 'sseqid'],
-                             right_on=['sseqid', 'qseqid'])
+    bbh_df = reciprocal_best_hit(best_hit(blasttab1), best_hit(blasttab2))
     bbh_df.to_csv(outfile,
                   sep='\t',
                   index=False,
-                  columns=['qseqid_x', 'sseqid_x', 'pident_x', 'pident_y'],
                   header=False)
 
 
@@ -92,34 +268,26 @@ class Blastobj:
 
     blast_file = attr.ib()
     blast_path = None
+    cache_dir = None
     _db_type = None
     _fa_file = None
+    _db_file = None
 
-    @property
+    @cached_property
     def _is_fasta(self):
-        if self.blast_file.is_file():
-            fasta = SeqIO.parse(self.blast_file, "fasta")
-            if any(fasta):
-                fasta = SeqIO.parse(self.blast_file, "fasta")
-                self._fa_file = self.blast_file
-                prot_seqs = itertools.takewhile(is_prot,
-                                                itertools.islice(fasta, 10))
-                if any(prot_seqs):
-                    self._db_type = 'prot'
-                else:
-                    self._db_type = 'nucl'
-                return True
+        seq_type = sniff_fasta(self.blast_file)
+        if seq_type is not None:
+            self._fa_file = self.blast_file
+            self._db_type = seq_type
+            return True
         return False
 
-    @property
+    @cached_property
     def _is_db(self):
-        suffix_set = set()
-        for file_i in self.blast_file.parent.glob(f'{self.blast_file.name}.*'):
-            suffix_set.add(file_i.suffix)
-        for dtype in DB_SUFFIX_DICT:
-            if len(suffix_set.intersection(DB_SUFFIX_DICT[dtype])) == 3:
-                self._db_type = dtype
-                return True
+        db_type = blast_db_type(self.blast_file)
+        if db_type is not None:
+            self._db_type = db_type
+            return True
         return False
 
     @property
@@ -141,28 +309,81 @@ class Blastobj:
         make blast database
         """
         logger.info(f'Making blast db for {self.fasta}')
-        delegator.run((f'{self.blast_path}/makeblastdb '
-                       f'-in {self.fasta} -dbtype {self._db_type}'))
+        if self.cache_dir is None:
+            delegator.run((f'{self.blast_path}/makeblastdb '
+                           f'-in {self.fasta} -dbtype {self.db_type}'))
+            return
+        # build aside and move into place, so a cached db is always complete
+        db_dir = self._db_file.parent
+        tmp_dir = db_dir / f'.{self._db_file.name}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        make_db = delegator.run((f'{self.blast_path}/makeblastdb '
+                                 f'-in {self.fasta} -dbtype {self.db_type} '
+                                 f'-out {tmp_dir / self._db_file.name}'))
+        if make_db.return_code != 0:
+            raise BlastRunError(f'makeblastdb failed: {make_db.err}')
+        for db_file_i in tmp_dir.iterdir():
+            db_file_i.replace(db_dir / db_file_i.name)
+        tmp_dir.rmdir()
 
     @property
     def db(self):
-        if not self._is_db:
-            self._make_db
-        return self.blast_file
+        if self._db_file is None:
+            if self._is_db:
+                self._db_file = self.blast_file
+            elif self.cache_dir is None:
+                self._db_file = self.blast_file
+                self._make_db
+            else:
+                fa_digest = file_digest(self.fasta, self.cache_dir)
+                self._db_file = (self.cache_dir /
+                                 f'{fa_digest}.{self.db_type}' /
+                                 self.fasta.name)
+                if blast_db_type(self._db_file) is None:
+                    self._make_db
+                else:
+                    logger.info(f'Using cached blast db {self._db_file}')
+        return self._db_file
 
     @property
     def _extract_fasta(self):
         """
         extract fasta from blast database
         """
-        logger.info(f'Extracting sequence from db {self.db}')
-        delegator.run((f'{self.blast_path}/blastdbcmd '
-                       f'-entry all -db {self.db} -out {self.db}.fasta'))
-        self._fa_file = Path(f'{self.db}.fasta')
+        db_sig = db_signature(self.db)
+        if self.cache_dir is None:
+            # signature is kept next to the fasta, not in its name
+            fa_file = Path(f'{self.db}.fasta')
+            sig_file = Path(f'{fa_file}.sig')
+            is_current = sig_file.exists() and sig_file.read_text() == db_sig
+        else:
+            fa_file = self.cache_dir / f'{db_sig}.{self.db.name}.fasta'
+            sig_file = None
+            is_current = True
+        if fa_file.exists() and is_current:
+            logger.info(f'Using extracted sequence {fa_file}')
+        else:
+            logger.info(f'Extracting sequence from db {self.db}')
+            tmp_fa_file = fa_file.with_suffix('.tmp')
+            extract_proc = delegator.run(
+                (f'{self.blast_path}/blastdbcmd '
+                 f'-entry all -db {self.db} -out {tmp_fa_file}'))
+            if extract_proc.return_code != 0:
+                if tmp_fa_file.exists():
+                    tmp_fa_file.unlink()
+                raise BlastRunError(
+                    f'Extracting {self.db} failed: {extract_proc.err}')
+            tmp_fa_file.rename(fa_file)
+            if sig_file is not None:
+                sig_file.write_text(db_sig)
+        self._fa_file = fa_file
 
     @property
     def fasta(self):
-        if self._is_fasta:
+        if self._fa_file is not None:
+            pass
+        elif self._is_fasta:
             pass
         elif self._is_db:
             self._extract_fasta
@@ -171,21 +392,56 @@ class Blastobj:
                                    'fasta or blast database is alowed.')
         return self._fa_file
 
+    def _blast_cmd(self, blast_program, query, other, blast_params):
+        return (f'{self.blast_path}/{blast_program} '
+                f'-query {query} '
+                f'-db {other.db} '
+                f'-evalue {blast_params.evalue} '
+                f'-outfmt {blast_params.outfmt} '
+                f'-max_target_seqs {blast_params.max_target_seqs} '
+                f'-num_threads {blast_params.num_threads} '
+                f'{blast_params.optionals}')
+
+    def _run_blast_chunks(self, blast_program, other, blast_params, outdir):
+        """
+        split query into chunks and run them in a process pool,
+        finished chunks are skipped when rerun.
+        """
+        chunk_dir = outdir / f'{self.blastout_file.name}.chunks'
+        blast_sig = [self._blast_cmd(blast_program, '{query}',
+                                     other, blast_params),
+                     db_signature(other.db)]
+        chunk_files = split_fasta(self.fasta, blast_params.chunks, chunk_dir,
+                                  blast_sig=blast_sig)
+        chunk_outs = [each.with_suffix('.blasttab') for each in chunk_files]
+        to_run = [(chunk_file, chunk_out) for chunk_file, chunk_out
+                  in zip(chunk_files, chunk_outs) if not chunk_out.exists()]
+        logger.info(f'{len(chunk_files) - len(to_run)} of {len(chunk_files)} '
+                    'chunks finished, running the rest '
+                    f'with {blast_params.workers} workers')
+        with ProcessPoolExecutor(max_workers=blast_params.workers) as pool:
+            chunk_jobs = [
+                pool.submit(run_blast_chunk,
+                            self._blast_cmd(blast_program, chunk_file,
+                                            other, blast_params),
+                            chunk_out)
+                for chunk_file, chunk_out in to_run]
+            for chunk_job in chunk_jobs:
+                chunk_job.result()
+        merge_blast_chunks(chunk_outs, self.blastout_file)
+
     def run_blast(self, other, blast_params, outdir):
         blast_program = BLAST_PROGRAM_DICT.get((self.db_type, other.db_type))
         blastout_name = f'{self.fasta.name}.{other.db.name}.blasttab'
         self.blastout_file = outdir / blastout_name
         logger.info(
             f'Running {blast_program} on {self.fasta} against {other.db}')
-        delegator.run((f'{self.blast_path}/{blast_program} '
-                       f'-query {self.fasta} '
-                       f'-db {other.db} '
-                       f'-evalue {blast_params.evalue} '
-                       f'-outfmt {blast_params.outfmt} '
-                       f'-max_target_seqs {blast_params.max_target_seqs} '
-                       f'-num_threads {blast_params.num_threads} '
-                       f'{blast_params.optionals} '
-                       f'-out {self.blastout_file}'))
+        if blast_params.chunks > 1:
+            self._run_blast_chunks(blast_program, other, blast_params, outdir)
+        else:
+            blast_cmd = self._blast_cmd(blast_program, self.fasta,
+                                        other, blast_params)
+            run_blast_chunk(blast_cmd, self.blastout_file)
         if blast_params.perc_identity:
             logger.info(('Filtering blast results percent identity '
                          f'less than {blast_params.perc_identity}'))
@@ -202,6 +458,8 @@ class BlastParams:
     max_target_seqs = attr.ib()
     num_threads = attr.ib()
     optionals = attr.ib()
+    chunks = attr.ib(default=1)
+    workers = attr.ib(default=1)
 
 
 @click.command()
@@ -271,9 +529,30 @@ class BlastParams:
     help='blast executable path.',
     default='',
 )
+@click.option(
+    '--chunks',
+    help=('split query into N chunks with balanced residue length, '
+          'finished chunks are skipped when rerun.'),
+    type=click.INT,
+    default=1,
+)
+@click.option(
+    '--workers',
+    help='number of blast chunks to run concurrently.',
+    type=click.INT,
+    default=1,
+)
+@click.option(
+    '--cache_dir',
+    help=('reuse blast databases built from identical fasta '
+          'and sequences extracted from databases in this directory.'),
+    type=click.Path(file_okay=False),
+    envvar='OMBLAST_CACHE_DIR',
+    default=None,
+)
 def main(input1, input2, outdir, evalue, outfmt, perc_identity,
          max_target_seqs, num_threads, optional_blast_options, bidirectional,
-         blast_path):
+         blast_path, chunks, workers, cache_dir):
     if blast_path:
         blast_path = Path(blast_path)
     elif shutil.which('blastn'):
@@ -282,6 +561,9 @@ def main(input1, input2, outdir, evalue, outfmt, perc_identity,
         raise BlastNotFound
 
     Blastobj.blast_path = blast_path
+    if cache_dir:
+        Blastobj.cache_dir = Path(cache_dir)
+        Blastobj.cache_dir.mkdir(parents=True, exist_ok=True)
 
     outdir = Path(outdir)
     outdir.mkdir(parents=True, exist_ok=True)
@@ -296,6 +578,8 @@ def main(input1, input2, outdir, evalue, outfmt, perc_identity,
         max_target_seqs,
         num_threads,
         optional_blast_options,
+        chunks,
+        workers,
     )
 
     input1_blast_obj = Blastobj(blast_file=Path(input1))
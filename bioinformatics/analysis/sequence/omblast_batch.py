@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import attr
+import yaml
+import click
+import shutil
+import pandas as pd
+from loguru import logger
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from omblast import Blastobj, BlastParams, BlastNotFound, CURRENT_DIR
+
+
+BLAST_PARAM_COLS = [
+    'evalue',
+    'outfmt',
+    'perc_identity',
+    'max_target_seqs',
+    'num_threads',
+    'optionals',
+    'chunks',
+    'workers',
+]
+
+BLAST_INT_PARAM_COLS = {
+    'outfmt',
+    'perc_identity',
+    'max_target_seqs',
+    'num_threads',
+    'chunks',
+    'workers',
+}
+
+SUMMARY_COLS = [
+    'name',
+    'query',
+    'db',
+    'threads',
+    'cost',
+    'status',
+    'start',
+    'end',
+    'elapsed',
+    'blastout',
+]
+
+
+def read_manifest(manifest):
+    '''
+    jobs from a yaml list (or {jobs: [...]}) or a tsv with header,
+    query and db are required, other columns override blast defaults.
+    '''
+    manifest = Path(manifest)
+    if manifest.suffix in ('.yaml', '.yml'):
+        jobs = yaml.safe_load(manifest.read_text())
+        if isinstance(jobs, dict):
+            jobs = jobs['jobs']
+        job_df = pd.DataFrame(jobs)
+    else:
+        job_df = pd.read_table(manifest, comment='#')
+    if 'name' not in job_df.columns:
+        job_df.loc[:, 'name'] = [
+            f'{Path(query).name}.{Path(db).name}'
+            for query, db in zip(job_df['query'], job_df['db'])]
+    job_df = job_df.astype(object).where(job_df.notna(), None)
+    return job_df.to_dict('records')
+
+
+def db_size(blast_obj):
+    db_file = blast_obj.db
+    seq_files = [each for each in db_file.parent.glob(f'{db_file.name}.*')
+                 if each.suffix in ('.nsq', '.psq')]
+    if not seq_files:
+        seq_files = [blast_obj.fasta]
+    return sum(each.stat().st_size for each in seq_files)
+
+
+@attr.s
+class BlastJob:
+
+    name = attr.ib()
+    query = attr.ib()
+    db = attr.ib()
+    params = attr.ib()
+    status_file = attr.ib()
+    cost = attr.ib(default=0)
+
+    @property
+    def threads(self):
+        return self.params.num_threads * self.params.workers
+
+    @property
+    def status(self):
+        if self.status_file.exists():
+            return json.loads(self.status_file.read_text())
+        return {}
+
+    def save_status(self, status):
+        tmp_file = self.status_file.with_suffix('.tmp')
+        tmp_file.write_text(json.dumps(status))
+        tmp_file.replace(self.status_file)
+
+    def run(self, outdir):
+        status = {'status': 'running', 'start': time.time()}
+        self.save_status(status)
+        # jobs on the same query and db do not share output files
+        job_dir = outdir / self.name
+        job_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            self.query.run_blast(self.db, self.params, job_dir)
+        except Exception as exc:
+            status['status'] = 'failed'
+            status['error'] = str(exc)
+            logger.error(f'{self.name} failed: {exc}')
+        else:
+            status['status'] = 'done'
+            status['blastout'] = str(self.query.blastout_file)
+        status['end'] = time.time()
+        status['elapsed'] = status['end'] - status['start']
+        self.save_status(status)
+        return status
+
+    def fail(self, error):
+        now = time.time()
+        status = {'status': 'failed', 'start': now, 'end': now,
+                  'elapsed': 0, 'error': error}
+        logger.error(f'{self.name} failed: {error}')
+        self.save_status(status)
+        return status
+
+
+def prepare_jobs(job_records, default_params, outdir, thread_budget):
+    '''
+    resolve fasta/db of every input once, before jobs share them,
+    job names are used for status and output paths and must be unique.
+    '''
+    job_names = pd.Series([record['name'] for record in job_records])
+    dup_names = job_names[job_names.duplicated()].unique()
+    if len(dup_names):
+        raise ValueError(f'duplicate job names: {", ".join(dup_names)}, '
+                         'name the jobs in the manifest.')
+    status_dir = outdir / 'batch_status'
+    status_dir.mkdir(parents=True, exist_ok=True)
+    db_objs = {}
+    jobs = []
+    for record in job_records:
+        job_params = {}
+        for key in BLAST_PARAM_COLS:
+            if record.get(key) is None:
+                continue
+            if key in BLAST_INT_PARAM_COLS:
+                job_params[key] = int(record[key])
+            else:
+                job_params[key] = record[key]
+        params = attr.evolve(default_params, **job_params)
+        # a job never asks for more threads than the whole budget
+        if params.workers > thread_budget:
+            params = attr.evolve(params, workers=max(thread_budget, 1))
+        max_threads = max(thread_budget // params.workers, 1)
+        if params.num_threads > max_threads:
+            params = attr.evolve(params, num_threads=max_threads)
+        query_obj = Blastobj(blast_file=Path(record['query']))
+        query_obj.fasta
+        query_obj.db_type
+        if record['db'] not in db_objs:
+            db_objs[record['db']] = Blastobj(blast_file=Path(record['db']))
+        db_obj = db_objs[record['db']]
+        db_obj.db
+        job = BlastJob(name=record['name'],
+                       query=query_obj,
+                       db=db_obj,
+                       params=params,
+                       status_file=status_dir / f'{record["name"]}.json')
+        job.cost = query_obj.fasta.stat().st_size * db_size(db_obj)
+        jobs.append(job)
+    # longest jobs first, so the short ones fill the gaps at the end
+    return sorted(jobs, key=lambda x: x.cost, reverse=True)
+
+
+def run_jobs(jobs, outdir, thread_budget):
+    '''
+    run jobs concurrently while the sum of their threads fits the budget
+    '''
+    pending = [job for job in jobs if job.status.get('status') != 'done']
+    logger.info(f'{len(jobs) - len(pending)} of {len(jobs)} jobs finished, '
+                f'running the rest with {thread_budget} threads')
+    # a job larger than the whole budget would wait forever
+    for job in list(pending):
+        if job.threads > thread_budget:
+            pending.remove(job)
+            job.fail(f'needs {job.threads} threads, '
+                     f'more than the budget of {thread_budget}')
+    free_threads = thread_budget
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(thread_budget, 1)) as pool:
+        while pending or running:
+            for job in list(pending):
+                if job.threads <= free_threads:
+                    logger.info(f'Starting {job.name} '
+                                f'with {job.threads} threads')
+                    pending.remove(job)
+                    free_threads -= job.threads
+                    running[pool.submit(job.run, outdir)] = job
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                free_threads += job.threads
+                status = future.result()
+                logger.info(f'{job.name} {status["status"]} '
+                            f'in {status["elapsed"]:.1f}s')
+
+
+def write_summary(jobs, summary_file):
+    summary_records = []
+    for job in jobs:
+        record = {'name': job.name,
+                  'query': job.query.blast_file,
+                  'db': job.db.blast_file,
+                  'threads': job.threads,
+                  'cost': job.cost}
+        record.update(job.status)
+        summary_records.append(record)
+    summary_df = pd.DataFrame(summary_records)
+    summary_df = summary_df.reindex(columns=SUMMARY_COLS)
+    for time_col in ('start', 'end'):
+        summary_df[time_col] = pd.to_datetime(summary_df[time_col],
+                                              unit='s').dt.floor('s')
+    summary_df.to_csv(summary_file, sep='\t', index=False,
+                      float_format='%.1f', na_rep='--')
+
+
+@click.command()
+@click.argument(
+    'manifest',
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    '-o',
+    '--outdir',
+    help='result directory.',
+    default=CURRENT_DIR,
+)
+@click.option(
+    '-t',
+    '--threads',
+    help='total threads shared by all blast jobs.',
+    type=click.INT,
+    default=os.cpu_count(),
+)
+@click.option(
+    '-evalue',
+    help='default blast evalue cutoff',
+    type=click.STRING,
+    default='1e-5',
+)
+@click.option(
+    '-outfmt',
+    help='default blast alignment view options',
+    type=click.INT,
+    default=6,
+)
+@click.option(
+    '-max_target_seqs',
+    help='default maximum number of aligned sequences to keep.',
+    type=click.INT,
+    default=500,
+)
+@click.option(
+    '-num_threads',
+    help='default threads of each blast job',
+    type=click.INT,
+    default=4,
+)
+@click.option(
+    '--blast_path',
+    help='blast executable path.',
+    default='',
+)
+@click.option(
+    '--cache_dir',
+    help='blast database cache directory.',
+    type=click.Path(file_okay=False),
+    envvar='OMBLAST_CACHE_DIR',
+    default=None,
+)
+def main(manifest, outdir, threads, evalue, outfmt, max_target_seqs,
+         num_threads, blast_path, cache_dir):
+    '''
+    run query x database blast jobs listed in MANIFEST (yaml or tsv)
+    '''
+    if blast_path:
+        blast_path = Path(blast_path)
+    elif shutil.which('blastn'):
+        blast_path = Path(shutil.which('blastn')).parent
+    else:
+        raise BlastNotFound
+
+    Blastobj.blast_path = blast_path
+    if cache_dir:
+        Blastobj.cache_dir = Path(cache_dir)
+        Blastobj.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    default_params = BlastParams(evalue, outfmt, None, max_target_seqs,
+                                 num_threads, '')
+    jobs = prepare_jobs(read_manifest(manifest), default_params,
+                        outdir, threads)
+    run_jobs(jobs, outdir, threads)
+    write_summary(jobs, outdir / 'batch_summary.txt')
+
+
+if __name__ == '__main__':
+    main()
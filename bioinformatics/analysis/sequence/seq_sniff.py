@@ -0,0 +1,52 @@
+import mmap
+import click
+from pathlib import Path
+
+
+SNIFF_BYTES = 1 << 20
+NUCL_RATIO = 0.9
+NUCL_LETTERS = b'ACGTUNacgtun'
+NON_LETTERS = bytes(set(range(256)).difference(
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz*-'))
+
+
+def sniff_fasta(fasta, sniff_bytes=SNIFF_BYTES):
+    '''
+    guess sequence type from the first `sniff_bytes` of a fasta file,
+    return 'nucl', 'prot' or None if the file does not look like fasta.
+
+    only the prefix is mapped, so the cost does not grow with file size.
+    '''
+    fasta = Path(fasta)
+    if not fasta.is_file() or fasta.stat().st_size == 0:
+        return None
+    with open(fasta, 'rb') as fasta_inf:
+        with mmap.mmap(fasta_inf.fileno(), 0,
+                       access=mmap.ACCESS_READ) as fasta_map:
+            prefix = fasta_map[:sniff_bytes]
+    if not prefix.lstrip().startswith(b'>'):
+        return None
+    seq_bytes = b''.join(line for line in prefix.split(b'\n')
+                         if not line.startswith(b'>'))
+    letters = seq_bytes.translate(None, NON_LETTERS)
+    if not letters:
+        return None
+    nucl_num = len(letters) - len(letters.translate(None, NUCL_LETTERS))
+    if nucl_num / len(letters) >= NUCL_RATIO:
+        return 'nucl'
+    return 'prot'
+
+
+@click.command()
+@click.argument(
+    'fasta',
+    type=click.Path(exists=True, dir_okay=False),
+    nargs=-1,
+)
+def main(fasta):
+    for each_fa in fasta:
+        print(f'{each_fa}\t{sniff_fasta(each_fa)}')
+
+
+if __name__ == '__main__':
+    main()
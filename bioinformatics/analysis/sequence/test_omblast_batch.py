@@ -0,0 +1,66 @@
+import pytest
+from omblast import BlastParams
+from omblast_batch import BlastJob, read_manifest, prepare_jobs, run_jobs
+
+
+class FakeQuery:
+
+    blastout_file = 'fake.blastout'
+
+    def __init__(self):
+        self.calls = 0
+        self.outdir = None
+
+    def run_blast(self, db, params, outdir):
+        self.calls += 1
+        self.outdir = outdir
+
+
+def make_job(tmp_path, name, num_threads, workers):
+    params = BlastParams('1e-5', 6, None, 500, num_threads, '',
+                         workers=workers)
+    return BlastJob(name=name, query=FakeQuery(), db=None, params=params,
+                    status_file=tmp_path / f'{name}.json')
+
+
+def test_run_jobs_fails_job_over_budget(tmp_path):
+    small_job = make_job(tmp_path, 'small', 2, 1)
+    large_job = make_job(tmp_path, 'large', 2, 4)
+    run_jobs([small_job, large_job], tmp_path, 4)
+    assert small_job.status['status'] == 'done'
+    assert large_job.status['status'] == 'failed'
+    assert 'budget of 4' in large_job.status['error']
+    assert large_job.query.calls == 0
+
+
+def test_prepare_jobs_caps_workers(tmp_path):
+    query = tmp_path / 'query.fa'
+    query.write_text('>seq1\nMKVLAAGIVALLLAAGCSS\n')
+    db = tmp_path / 'db'
+    for suffix in ('.pin', '.phr', '.psq'):
+        (tmp_path / f'db{suffix}').write_text('')
+    default_params = BlastParams('1e-5', 6, None, 500, 4, '')
+    records = [{'name': 'job', 'query': str(query), 'db': str(db),
+                'workers': 8}]
+    job, = prepare_jobs(records, default_params, tmp_path, 3)
+    assert job.params.workers == 3
+    assert job.params.num_threads == 1
+    assert job.threads <= 3
+
+
+def test_prepare_jobs_rejects_duplicate_names(tmp_path):
+    manifest = tmp_path / 'jobs.tsv'
+    manifest.write_text('query\tdb\tevalue\n'
+                        'query.fa\tdb\t1e-5\n'
+                        'query.fa\tdb\t1e-10\n')
+    default_params = BlastParams('1e-5', 6, None, 500, 4, '')
+    with pytest.raises(ValueError, match='query.fa.db'):
+        prepare_jobs(read_manifest(manifest), default_params, tmp_path, 4)
+
+
+def test_run_jobs_separate_outdirs(tmp_path):
+    jobs = [make_job(tmp_path, 'strict', 1, 1),
+            make_job(tmp_path, 'loose', 1, 1)]
+    run_jobs(jobs, tmp_path, 2)
+    assert [job.query.outdir for job in jobs] == [tmp_path / 'strict',
+                                                  tmp_path / 'loose']
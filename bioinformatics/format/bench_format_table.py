@@ -0,0 +1,66 @@
+import time
+import click
+import numpy as np
+import pandas as pd
+from format_table import collapse_df
+
+
+def legacy_collapse_df(gene_df, by, sep='||', empty_rep=None):
+
+    def my_unique(x):
+        unique_x = pd.unique(x.dropna())
+        if str(unique_x.dtype) == 'float64':
+            unique_x = unique_x.astype('int')
+        unique_x = [str(each) for each in unique_x]
+        if not unique_x:
+            if empty_rep is None:
+                return None
+            else:
+                unique_x = [empty_rep]
+        return sep.join(unique_x)
+
+    return gene_df.groupby(by).agg(my_unique)
+
+
+def fake_anno_table(row_num, gene_num, seed=0):
+    rng = np.random.default_rng(seed)
+    anno_df = pd.DataFrame({
+        'gene_id': [f'gene{each}' for each in
+                    rng.integers(0, gene_num, row_num)],
+        'go_id': [f'GO:{each:0>7}' for each in
+                  rng.integers(0, 5000, row_num)],
+        'pfam_ids': [f'PF{each:0>5}' for each in
+                     rng.integers(0, 500, row_num)],
+        'pubmed_ids': rng.integers(10 ** 6, 10 ** 6 + 2000,
+                                   row_num).astype(float),
+    })
+    anno_df.loc[rng.random(row_num) < 0.3, 'pfam_ids'] = None
+    anno_df.loc[rng.random(row_num) < 0.3, 'pubmed_ids'] = np.nan
+    return anno_df
+
+
+@click.command()
+@click.option('--row_num', default=1000000, type=click.INT)
+@click.option('--gene_num', default=40000, type=click.INT)
+def main(row_num, gene_num):
+    '''
+    time per-group my_unique aggregation against collapse_df
+    '''
+    anno_df = fake_anno_table(row_num, gene_num)
+
+    start = time.perf_counter()
+    legacy_df = legacy_collapse_df(anno_df, 'gene_id', empty_rep='--')
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    collapse_out_df = collapse_df(anno_df, 'gene_id', empty_rep='--')
+    collapse_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(legacy_df, collapse_out_df)
+    print(f'rows: {row_num}, genes: {gene_num}')
+    print(f'per-group my_unique: {legacy_time:.2f}s')
+    print(f'collapse_df: {collapse_time:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,37 @@ import fire
 import pandas as pd
 
 
+def collapse_df(gene_df, by, sep='||', empty_rep=None):
+    '''
+    condense rows with identical `by` values to one row, unique values
+    of the other columns are joined by `sep` in order of appearance,
+    float values are written as int, groups without any value of a
+    column get `empty_rep`.
+
+    values are deduplicated on (key, value) for each column and joined
+    in one groupby per column, not by a python function per group.
+    '''
+    by_cols = [by] if isinstance(by, str) else list(by)
+    gene_df = gene_df.dropna(subset=by_cols)
+    keys = gene_df.loc[:, by_cols].drop_duplicates().set_index(by_cols)
+    keys = keys.sort_index().index
+    out_cols = dict()
+    for each_col in gene_df.columns.difference(by_cols, sort=False):
+        col_df = gene_df.loc[:, by_cols + [each_col]].dropna()
+        if col_df[each_col].dtype == 'float64':
+            col_df[each_col] = col_df[each_col].astype('int64')
+        col_df[each_col] = col_df[each_col].astype(str)
+        col_df = col_df.drop_duplicates()
+        out_cols[each_col] = col_df.groupby(
+            by_cols, sort=False)[each_col].agg(sep.join).reindex(keys)
+    out_df = pd.DataFrame(out_cols, index=keys,
+                          columns=gene_df.columns.difference(
+                              by_cols, sort=False))
+    if empty_rep is not None:
+        out_df = out_df.fillna(empty_rep)
+    return out_df
+
+
 def format_df(table_file, by, outfile, sep='||', empty_rep=None):
     '''
     condense multi row to one by identical column value
@@ -9,26 +40,7 @@ def format_df(table_file, by, outfile, sep='||', empty_rep=None):
 
     gene_df = pd.read_table(table_file)
     gene_df.dropna(inplace=True)
-
-    def my_unique(x, sep='||'):
-        nonlocal empty_rep
-        unique_x = pd.unique(x.dropna())
-        if str(unique_x.dtype) == 'float64':
-            unique_x = unique_x.astype('int')
-        unique_x = [str(each) for each in unique_x]
-        if not unique_x:
-            if empty_rep is None:
-                return None
-            else:
-                unique_x = [empty_rep]
-        try:
-            sep.join(unique_x)
-        except TypeError:
-            print(unique_x)
-            print(x)
-        return sep.join(unique_x)
-
-    gene_df = gene_df.groupby(by).agg(my_unique)
+    gene_df = collapse_df(gene_df, by, sep=sep, empty_rep=empty_rep)
     gene_df.to_csv(outfile, sep='\t')
 
 
@@ -1,14 +1,23 @@
 import pandas as pd
-import numpy as np
 import click
 
 
-def join_col(obj, sep=',', ignore_char='--'):
-    if isinstance(obj, str):
-        return obj
-    else:
-        clean_obj = [each for each in obj if each != ignore_char]
-        return sep.join(clean_obj)
+def unique_join(des_df, by, sep=',', ignore_char='--'):
+    '''
+    sorted unique values of each column per `by` value joined by `sep`,
+    `ignore_char` values are left out. values are deduplicated in long
+    form and joined in one groupby, not by np.unique per group.
+    '''
+    long_df = des_df.melt(id_vars=[by], var_name='column')
+    long_df = long_df[long_df.value != ignore_char].dropna()
+    long_df.loc[:, 'value'] = long_df.value.astype(str)
+    long_df = long_df.drop_duplicates().sort_values([by, 'column', 'value'])
+    join_df = long_df.groupby([by, 'column'], sort=False).value.agg(
+        sep.join).unstack('column')
+    genes = des_df[by].drop_duplicates().sort_values()
+    join_df = join_df.reindex(index=genes, columns=des_df.columns.drop(by))
+    join_df.columns.name = None
+    return join_df.fillna('')
 
 
 @click.command()
@@ -25,9 +34,7 @@ def join_col(obj, sep=',', ignore_char='--'):
 def main(gene_des, output):
     gene_des_df = pd.read_table(gene_des)
     gene_col = gene_des_df.columns[0]
-    groupdf = gene_des_df.groupby([gene_col])
-    des_df = groupdf.aggregate(np.unique)
-    des_df = des_df.applymap(join_col)
+    des_df = unique_join(gene_des_df, gene_col)
     des_df.to_csv(output, sep='\t')
 
 
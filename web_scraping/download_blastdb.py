@@ -1,5 +1,8 @@
 import itertools
 import sys
+import os
+import json
+import hashlib
 import asyncio
 import aioftp
 import pathlib
@@ -7,10 +10,13 @@ import fire
 import re
 import pandas as pd
 import gzip
+import tarfile
 import concurrent
+import concurrent.futures
 import logging
 from tabulate import tabulate
 from collections import Counter
+from ftp_pool import FTPPool
 
 
 def init_logger(log_name=None, log_file=None, level=logging.INFO,
@@ -38,13 +44,25 @@ def init_logger(log_name=None, log_file=None, level=logging.INFO,
 DEFAULT_LOGGER = init_logger()
 
 
-SEMA = asyncio.Semaphore(5)
 CURRENT_DIR = pathlib.Path().cwd()
 HOST = "ftp.ncbi.nlm.nih.gov"
+PORT = 21
+DEFAULT_CONCUR_FILES = 5
+DEFAULT_SEGMENTS = 4
+# files smaller than this are downloaded as one segment
+MIN_SEGMENT_SIZE = 64 * 1024 ** 2
+# segment progress is saved to the sidecar every this many bytes
+CHECKPOINT_BYTES = 32 * 1024 ** 2
+HASH_BLOCK = 8 * 1024 ** 2
+FINISH_TIMEOUT = 5
+DEFAULT_EXTRACT_WORKERS = 4
+FTP_ERRORS = (asyncio.TimeoutError, aioftp.errors.StatusCodeError,
+              ConnectionError, OSError)
 
 
-async def get_inf(host, name=None,
+async def get_inf(pool, name=None,
                   retry_lim=1,
+                  refresh=False,
                   logger=DEFAULT_LOGGER):
     file_list = []
     retry_num = 0
@@ -52,88 +70,238 @@ async def get_inf(host, name=None,
     # name is None means to retrieve all files of blastdb
     if name is None:
         out_name = 'NCBI Blast Database'
-    with (await SEMA):
-        while retry_num <= retry_lim:
-            try:
-                async with aioftp.ClientSession(
-                        host, socket_timeout=10) as client:
-                    path = '/blast/db/'
-                    logger.info(
-                        f'Retriving blastdb files. Try {retry_num + 1}.')
-                    for path, info in (await client.list(path)):
-                        if info['type'] == 'file' and (path.suffix == '.gz' or
-                                                       path.suffix == '.md5'):
-                            if name is None:
-                                name = '.*'
-                            pattern = re.compile(
-                                '{pref}\..*tar.gz.*'.format(
-                                    pref=name
-                                ))
-                            if pattern.match(path.name):
-                                file_list.append(path)
-                    file_number = len(file_list)
-                    logger.info(
-                        f'Total {file_number} files for [{out_name}] database.')
-                    return file_list
-            except concurrent.futures._base.TimeoutError:
-                retry_num += 1
-            except aioftp.errors.StatusCodeError:
-                retry_num += 1
-            except ConnectionResetError:
-                retry_num += 1
-        logger.error('Failed to connect to the FTP host.')
-        logger.error(f'Please check host IP [{host}] and try again!')
+    while retry_num <= retry_lim:
+        try:
+            path = '/blast/db/'
+            logger.info(
+                f'Retriving blastdb files. Try {retry_num + 1}.')
+            # listing is cached by the pool
+            for path, info in (await pool.list(path, refresh=refresh)):
+                if info['type'] == 'file' and (path.suffix == '.gz' or
+                                               path.suffix == '.md5'):
+                    if name is None:
+                        name = '.*'
+                    pattern = re.compile(
+                        '{pref}\..*tar.gz.*'.format(
+                            pref=name
+                        ))
+                    if pattern.match(path.name):
+                        file_list.append(path)
+            file_number = len(file_list)
+            logger.info(
+                f'Total {file_number} files for [{out_name}] database.')
+            return file_list
+        except concurrent.futures._base.TimeoutError:
+            retry_num += 1
+        except aioftp.errors.StatusCodeError:
+            retry_num += 1
+        except ConnectionResetError:
+            retry_num += 1
+    logger.error('Failed to connect to the FTP host.')
+    logger.error(f'Please check host IP [{pool.host}] and try again!')
+    return None
+
+
+def plan_segments(size, segments):
+    '''
+    split [0, size) into `segments` ranges of [start, end, downloaded_to],
+    an empty file is one empty range.
+    '''
+    if size == 0:
+        return [[0, 0, 0]]
+    if size < MIN_SEGMENT_SIZE:
+        segments = 1
+    seg_size = -(-size // segments)
+    return [[start, min(start + seg_size, size), start]
+            for start in range(0, size, seg_size)]
+
+
+def load_checkpoint(checkpoint_file, size, segments):
+    '''
+    segment progress of a previous run, a new plan if the sidecar is
+    missing or the remote file changed size.
+    '''
+    if checkpoint_file.exists():
+        with open(checkpoint_file) as checkpoint_inf:
+            checkpoint = json.load(checkpoint_inf)
+        if checkpoint['size'] == size:
+            return checkpoint['segments']
+    return plan_segments(size, segments)
+
+
+def save_checkpoint(checkpoint_file, size, seg_list):
+    tmp_file = checkpoint_file.with_name(checkpoint_file.name + '.tmp')
+    with open(tmp_file, 'w') as tmp_inf:
+        json.dump({'size': size, 'segments': seg_list}, tmp_inf)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def hashed_to(seg_list):
+    '''
+    end of the downloaded prefix of the file
+    '''
+    for start, end, pos in seg_list:
+        if pos < end:
+            return pos
+    return seg_list[-1][1]
+
+
+async def get_remote_md5(client, path):
+    '''
+    md5 of `path` from its `.md5` file, None if there is no `.md5`
+    '''
+    md5_path = f'{path}.md5'
+    if not await client.exists(md5_path):
         return None
+    md5_content = b''
+    async with client.download_stream(md5_path) as stream:
+        async for block in stream.iter_by_block():
+            md5_content += block
+    return md5_content.decode().split()[0]
+
 
+async def get_segment(pool, path, part_file, segment, on_progress):
+    '''
+    download [segment[2], segment[1]) of `path` into the same range of
+    `part_file` over its own FTP connection, segment[2] is moved on as
+    blocks are written.
+    '''
+    start, end, pos = segment
+    if pos >= end:
+        return
+    async with pool.client() as client:
+        stream = await client.download_stream(path, offset=pos)
+        with open(part_file, 'r+b', buffering=0) as part_out:
+            part_out.seek(pos)
+            async for block in stream.iter_by_block():
+                block = block[:end - segment[2]]
+                part_out.write(block)
+                segment[2] += len(block)
+                on_progress(len(block))
+                if segment[2] >= end:
+                    break
+        # the rest of the file is not wanted, the data connection is
+        # dropped and the server answers the cut transfer with 2xx/4xx,
+        # if it does not the client is not reused.
+        try:
+            await asyncio.wait_for(stream.finish(('2xx', '4xx')),
+                                   FINISH_TIMEOUT)
+        except FTP_ERRORS:
+            pool.discard(client)
+    if segment[2] < end:
+        raise ConnectionResetError(f'{path} segment ended early.')
+
+
+async def hash_part(part_file, seg_list, md5, segments_done):
+    '''
+    md5 the downloaded prefix of `part_file` while segments are still
+    running, returns the number of bytes hashed.
+    '''
+    loop = asyncio.get_event_loop()
+    size = seg_list[-1][1]
+    hashed = 0
+    with open(part_file, 'rb') as part_inf:
+        while hashed < size:
+            hash_end = min(hashed_to(seg_list), hashed + HASH_BLOCK)
+            if hash_end <= hashed:
+                if segments_done.is_set():
+                    break
+                await asyncio.sleep(0.5)
+                continue
+            block = await loop.run_in_executor(
+                None, part_inf.read, hash_end - hashed)
+            md5.update(block)
+            hashed += len(block)
+    return hashed
 
-async def get_file(host, path, out_dir=CURRENT_DIR,
-                   retry_lim=2, logger=DEFAULT_LOGGER):
-    with (await SEMA):
+
+async def get_file(pool, path, out_dir=CURRENT_DIR, semaphore=None,
+                   segments=DEFAULT_SEGMENTS, retry_lim=2,
+                   logger=DEFAULT_LOGGER):
+    '''
+    download `path` as `segments` ranges in parallel into a `.part`
+    file, progress is kept in a `.part.json` sidecar so a retry or a new
+    run only downloads the missing ranges. The file is checked against
+    its `.md5` on the server before it is renamed to the final name.
+    '''
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_CONCUR_FILES)
+    file_name = pathlib.PurePath(path).name
+    outfile = pathlib.Path(out_dir) / file_name
+    part_file = outfile.with_name(f'{file_name}.part')
+    checkpoint_file = outfile.with_name(f'{file_name}.part.json')
+    async with semaphore:
         retry_times = 0
         while retry_times <= retry_lim:
             try:
-                async with aioftp.ClientSession(
-                        host, socket_timeout=30) as client:
+                async with pool.client() as client:
                     # get download file stat
-                    if await client.exists(path):
-                        stat = await client.stat(path)
-                        size = int(stat["size"])
-                    else:
+                    if not await client.exists(path):
                         logger.error(f'{file_name} not exists in server!')
-                    file_name = pathlib.PurePath(path).name
-                    outfile = out_dir / file_name
-                    if pathlib.Path(outfile).exists():
-                        outfile_stat = pathlib.Path(outfile).stat()
-                        outfile_size = outfile_stat.st_size
-                    else:
-                        outfile_size = 0
-                    if outfile_size != size:
-                        logger.info(f'|Downloading...| {file_name}')
-                        file_out = open(outfile, 'ab')
-                        async with client.download_stream(
-                                path, offset=outfile_size) as stream:
-                            async for block in stream.iter_by_block():
-                                file_out.write(block)
-                        stream.close()
-                        file_out.close()
-                    else:
-                        pass
+                        return False
+                    stat = await client.stat(path)
+                    size = int(stat["size"])
+                    remote_md5 = None
+                    if pathlib.PurePath(path).suffix != '.md5':
+                        remote_md5 = await get_remote_md5(client, path)
+                if (outfile.exists() and not checkpoint_file.exists() and
+                        outfile.stat().st_size == size):
                     logger.info(f'|Downloaded| {file_name}')
                     return True
-            except TimeoutError:
-                retry_times += 1
-            except concurrent.futures._base.TimeoutError:
-                retry_times += 1
-            except aioftp.errors.StatusCodeError:
-                retry_times += 1
-            except ConnectionResetError:
+                seg_list = load_checkpoint(checkpoint_file, size, segments)
+                if not part_file.exists():
+                    seg_list = plan_segments(size, segments)
+                    with open(part_file, 'wb') as part_out:
+                        part_out.truncate(size)
+                save_checkpoint(checkpoint_file, size, seg_list)
+                logger.info(f'|Downloading...| {file_name}')
+                unsaved = [0]
+
+                def on_progress(block_size):
+                    unsaved[0] += block_size
+                    if unsaved[0] >= CHECKPOINT_BYTES:
+                        save_checkpoint(checkpoint_file, size, seg_list)
+                        unsaved[0] = 0
+
+                md5 = hashlib.md5()
+                segments_done = asyncio.Event()
+                hash_task = asyncio.ensure_future(
+                    hash_part(part_file, seg_list, md5, segments_done))
+                seg_tasks = [
+                    asyncio.create_task(get_segment(
+                        pool, path, part_file, each_seg, on_progress))
+                    for each_seg in seg_list]
+                try:
+                    await asyncio.gather(*seg_tasks)
+                except BaseException:
+                    # stop the other segments before the retry starts
+                    # new ones on the same ranges
+                    for each_task in seg_tasks + [hash_task]:
+                        each_task.cancel()
+                    await asyncio.gather(*seg_tasks, hash_task,
+                                         return_exceptions=True)
+                    raise
+                finally:
+                    save_checkpoint(checkpoint_file, size, seg_list)
+                segments_done.set()
+                await hash_task
+                if remote_md5 is not None and md5.hexdigest() != remote_md5:
+                    logger.error(f'|MD5 mismatch| {file_name}')
+                    part_file.unlink()
+                    checkpoint_file.unlink()
+                    retry_times += 1
+                    continue
+                os.replace(part_file, outfile)
+                checkpoint_file.unlink()
+                logger.info(f'|Downloaded| {file_name}')
+                return True
+            except FTP_ERRORS:
                 retry_times += 1
         logger.error(f'|Failed!| {file_name}')
         return False
 
 
-@asyncio.coroutine
-def spin(msg):
+async def spin(msg):
     '''
     show a spinning line
     '''
@@ -144,23 +312,23 @@ def spin(msg):
         flush()
         write('\x08' * len(status))
         try:
-            yield from asyncio.sleep(.1)
+            await asyncio.sleep(.1)
         except asyncio.CancelledError:
             break
     write(' ' * len(status) + '\x08' * len(status))
 
 
-@asyncio.coroutine
-def get_db_inf(msg='Fetching FTP information!',
-               show_spin=True,
-               db=None):
+async def get_db_inf(pool, msg='Fetching FTP information!',
+                     show_spin=True,
+                     db=None,
+                     refresh=False):
     # when downloading, don not show spinning line
     if show_spin:
-        spinner = asyncio.async(spin(msg))
-        file_list = yield from get_inf(HOST, name=db)
+        spinner = asyncio.ensure_future(spin(msg))
+        file_list = await get_inf(pool, name=db, refresh=refresh)
         spinner.cancel()
     else:
-        file_list = yield from get_inf(HOST, name=db)
+        file_list = await get_inf(pool, name=db, refresh=refresh)
     return file_list
 
 
@@ -176,37 +344,140 @@ def file_counter(file_list, file_suffix, file_label):
     return db_file_df.loc[:, ['NCBI_Blast_Database', file_label]]
 
 
+def extract_archive(archive_file, out_dir, keep_archive=False):
+    '''
+    untar a downloaded archive into `out_dir` (run in a worker process),
+    an `.extracted` marker replaces the archive so it is not downloaded
+    again.
+    '''
+    archive_file = pathlib.Path(archive_file)
+    with tarfile.open(archive_file, 'r:gz') as archive_inf:
+        if hasattr(tarfile, 'data_filter'):
+            archive_inf.extractall(out_dir, filter='data')
+        else:
+            archive_inf.extractall(
+                out_dir, members=checked_members(archive_inf, out_dir))
+    extract_marker(archive_file).touch()
+    if not keep_archive:
+        archive_file.unlink()
+    return archive_file.name
+
+
+def checked_members(archive_inf, out_dir):
+    '''
+    members of `archive_inf`, for Pythons without extraction filters:
+    files and directories inside `out_dir` only, no links or devices.
+    '''
+    out_dir = pathlib.Path(out_dir).resolve()
+    for member in archive_inf.getmembers():
+        member_path = (out_dir / member.name).resolve()
+        if out_dir != member_path and out_dir not in member_path.parents:
+            raise tarfile.TarError(f'{member.name} is outside {out_dir}')
+        if not (member.isfile() or member.isdir()):
+            raise tarfile.TarError(f'{member.name} is not a regular file')
+        yield member
+
+
+def extract_marker(archive_file):
+    return archive_file.with_name(f'{archive_file.name}.extracted')
+
+
+async def download_extract(pool, path, out_dir, semaphore, segments,
+                           logger, extract_pool=None, keep_archive=False):
+    '''
+    download `path`, archives are handed to `extract_pool` as soon as
+    their md5 is checked, the download slot is free for the next file
+    while the archive is extracted.
+    '''
+    archive_file = pathlib.Path(out_dir) / pathlib.PurePath(path).name
+    is_archive = archive_file.name.endswith('.tar.gz')
+    if extract_pool is not None and is_archive:
+        if extract_marker(archive_file).exists():
+            logger.info(f'|Extracted| {archive_file.name}')
+            return True
+    downloaded = await get_file(pool, path=path, out_dir=out_dir,
+                                semaphore=semaphore, segments=segments,
+                                logger=logger)
+    if not downloaded or extract_pool is None or not is_archive:
+        return downloaded
+    logger.info(f'|Extracting...| {archive_file.name}')
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(extract_pool, extract_archive,
+                                   archive_file, out_dir, keep_archive)
+    except (tarfile.TarError, EOFError, OSError) as exc:
+        logger.error(f'|Extract failed!| {archive_file.name}: {exc}')
+        return False
+    logger.info(f'|Extracted| {archive_file.name}')
+    return True
+
+
+async def download_files(pool, file_list, out_dir, concur_files, segments,
+                         logger, extract_pool=None, keep_archive=False):
+    semaphore = asyncio.Semaphore(concur_files)
+    return await asyncio.gather(*[
+        download_extract(pool, each_path, out_dir, semaphore, segments,
+                         logger, extract_pool=extract_pool,
+                         keep_archive=keep_archive)
+        for each_path in file_list])
+
+
 def download_ncbi_blastdb(database,
                           out_dir=CURRENT_DIR,
-                          test=False):
+                          test=False,
+                          concur_files=DEFAULT_CONCUR_FILES,
+                          segments=DEFAULT_SEGMENTS,
+                          extract=False,
+                          extract_workers=DEFAULT_EXTRACT_WORKERS,
+                          keep_archive=False,
+                          refresh_list=False):
+    '''
+    download all files of `database`, with `extract` archives are
+    extracted into `out_dir` by `extract_workers` processes while the
+    other files are still downloading, and removed after extraction
+    unless `keep_archive`. `refresh_list` lists the server again
+    instead of using the cached listing.
+    '''
 
     logger_file = pathlib.PurePath(out_dir) / 'download.log.txt'
     dl_logger = init_logger(log_name='download_ncbi_blastdb',
                             log_file=logger_file)
 
     loop = asyncio.get_event_loop()
+    # one connection per segment of each running file
+    pool = FTPPool(HOST, PORT, size=concur_files * segments)
     db_msg = f'Fetching dababase [{database}] files.'
     file_list = loop.run_until_complete(
-        get_db_inf(db_msg,
+        get_db_inf(pool, db_msg,
                    db=database,
-                   show_spin=False))
+                   show_spin=False,
+                   refresh=refresh_list))
 
     if file_list is None:
+        pool.close()
         return
 
     if test:
         for each_file in file_list:
             print(each_file)
+        pool.close()
         loop.close()
     else:
-        download_tasks = [
-            get_file(HOST, path=each_path, logger=dl_logger) for each_path
-            in file_list]
-        download_status, _ = loop.run_until_complete(
-            asyncio.wait(download_tasks))
+        extract_pool = None
+        if extract:
+            extract_pool = concurrent.futures.ProcessPoolExecutor(
+                extract_workers)
+        download_status = loop.run_until_complete(
+            download_files(pool, file_list, out_dir, concur_files,
+                           segments, dl_logger, extract_pool=extract_pool,
+                           keep_archive=keep_archive))
+        pool.close()
         loop.close()
+        dl_logger.info(pool.conn_stats)
+        if extract_pool is not None:
+            extract_pool.shutdown()
         total_works = len(download_status)
-        success_works = sum([each.result() for each in download_status])
+        success_works = sum(download_status)
         failed_works = total_works - success_works
         dl_logger.info(f'{total_works} files to be downloaded.')
         dl_logger.info(f'{success_works} success.')
@@ -215,9 +486,12 @@ def download_ncbi_blastdb(database,
             dl_logger.info('Check log file for failed files.')
 
 
-def list_db():
+def list_db(refresh_list=False):
     loop = asyncio.get_event_loop()
-    file_list = loop.run_until_complete(get_db_inf())
+    pool = FTPPool(HOST, PORT)
+    file_list = loop.run_until_complete(
+        get_db_inf(pool, refresh=refresh_list))
+    pool.close()
     loop.close()
     if file_list is None:
         return
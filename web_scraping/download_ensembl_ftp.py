@@ -1,15 +1,23 @@
+import os
+import json
 import asyncio
-import aioftp
 import pathlib
 import fire
 import re
+import aioftp
 import pandas as pd
-import gzip
+from ftp_pool import FTPPool
 
 
-SEMA = asyncio.Semaphore(5)
 CURRENT_DIR = pathlib.Path().cwd()
 HOST = "ftp.ensemblgenomes.org"
+PORT = 21
+DEFAULT_CONCUR_FILES = 5
+FILE_TYPES = ('cds', 'pep', 'gtf', 'dna')
+MANIFEST_NAME = 'ensembl_manifest.json'
+DEFAULT_RETRY = 3
+FTP_ERRORS = (asyncio.TimeoutError, aioftp.StatusCodeError,
+              ConnectionError, OSError)
 
 
 def ensembl_file_path(species, g_version, d_version):
@@ -37,6 +45,12 @@ def ensembl_file_path(species, g_version, d_version):
     pep_file = base_path / 'fasta/{sp}/pep/{name}'.format(
         sp=species, name=pep_file_name
     )
+    dna_file_name = '{pref}.dna.toplevel.fa.gz'.format(
+        pref=file_pref
+    )
+    dna_file = base_path / 'fasta/{sp}/dna/{name}'.format(
+        sp=species, name=dna_file_name
+    )
     test_file_name = '{pref}.dna.toplevel.fa.gz.fai'.format(pref=file_pref)
     test_file = base_path / 'fasta/{sp}/dna_index/{name}'.format(
         sp=species, name=test_file_name
@@ -45,57 +59,131 @@ def ensembl_file_path(species, g_version, d_version):
         'cds': cds_file,
         'gtf': gtf_file,
         'pep': pep_file,
+        'dna': dna_file,
         'test_file': test_file
     }
     return out_dict
 
 
-async def get_inf(host, species, version, info_dict):
-    with (await SEMA):
-        async with aioftp.ClientSession(host) as client:
-            path = '/pub/plants/release-{ver}/fasta/{sp}/cds/'.format(
-                ver=version, sp=species
-            )
-            for path, info in (await client.list(path)):
-                if info['type'] == 'file' and path.suffix == '.gz':
-                    pattern = re.compile('{pref}.(\S+).cds.all.fa.gz'.format(
-                        pref=species.capitalize()
-                    ))
-                    g_version = pattern.match(path.name).groups()[0]
-                    info_dict[species] = g_version
-
-
-async def get_file(host, path, out_dir=CURRENT_DIR):
-    with (await SEMA):
-        async with aioftp.ClientSession(host, socket_timeout=30) as client:
-            # get download file stat
-            if await client.exists(path):
-                stat = await client.stat(path)
-                size = int(stat["size"])
-            else:
-                print('{fi} not exists!'.format(fi=path))
-            file_name = pathlib.PurePath(path).name
-            outfile = out_dir / file_name
-            if pathlib.Path(outfile).exists():
-                outfile_stat = pathlib.Path(outfile).stat()
-                outfile_size = outfile_stat.st_size
-                if outfile_size != size:
-                    print('Downloading {fi}'.format(fi=file_name))
-                    file_out = gzip.open(outfile, 'ab')
-                    async with client.download_stream(
-                            path, offset=outfile_size) as stream:
-                        file_out.write(stream)
-                    file_out.close()
-                else:
-                    pass
-            else:
-                print('Downloading {fi}'.format(fi=file_name))
-                await client.download(path, outfile, write_into=True)
-            print('Download {fi} finished.'.format(fi=file_name))
+def dir_lister(pool):
+    '''
+    list remote directories once per run, listings are fresh so
+    changed files are seen, concurrent callers share a request.
+    '''
+    listings = dict()
+
+    def list_dir(path):
+        path = str(path)
+        if path not in listings:
+            listings[path] = asyncio.ensure_future(
+                pool.list(path, refresh=True))
+        return listings[path]
+
+    return list_dir
+
+
+async def get_inf(list_dir, species, version, info_dict):
+    path = '/pub/plants/release-{ver}/fasta/{sp}/cds/'.format(
+        ver=version, sp=species
+    )
+    for path, info in (await list_dir(path)):
+        if info['type'] == 'file' and path.suffix == '.gz':
+            pattern = re.compile('{pref}.(\S+).cds.all.fa.gz'.format(
+                pref=species.capitalize()
+            ))
+            g_version = pattern.match(path.name).groups()[0]
+            info_dict[species] = g_version
+
+
+async def get_remote_inf(list_dir, path):
+    '''
+    size and modify time of a remote file, None if it does not exist
+    '''
+    path = pathlib.PurePosixPath(path)
+    for each_path, info in (await list_dir(path.parent)):
+        if each_path.name == path.name and info['type'] == 'file':
+            return {'remote': str(path),
+                    'size': int(info['size']),
+                    'modify': info.get('modify')}
+    return None
+
+
+def load_manifest(manifest_file):
+    if manifest_file.exists():
+        with open(manifest_file) as manifest_inf:
+            return json.load(manifest_inf)
+    return dict()
+
+
+def save_manifest(manifest_file, manifest):
+    tmp_file = manifest_file.with_name(f'{manifest_file.name}.tmp')
+    with open(tmp_file, 'w') as tmp_inf:
+        json.dump(manifest, tmp_inf, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+async def get_file(pool, path, outfile, offset=0):
+    async with pool.client() as client:
+        with open(outfile, 'ab' if offset else 'wb') as file_out:
+            async with client.download_stream(
+                    path, offset=offset) as stream:
+                async for block in stream.iter_by_block():
+                    file_out.write(block)
+
+
+async def sync_file(pool, remote_inf, out_dir, manifest, manifest_file,
+                    retry_lim=DEFAULT_RETRY):
+    '''
+    download a file if it is missing, partial or changed on the server,
+    the manifest entry is written before the download starts, so a
+    partial file is resumed only if the remote file is unchanged.
+    an interrupted download is resumed up to `retry_lim` times.
+    '''
+    file_name = pathlib.PurePosixPath(remote_inf['remote']).name
+    outfile = pathlib.Path(out_dir) / file_name
+    size = remote_inf['size']
+    local_size = outfile.stat().st_size if outfile.exists() else 0
+    entry = manifest.get(file_name)
+    changed = entry is not None and entry != remote_inf
+    if changed or local_size > size:
+        offset = 0
+    else:
+        offset = local_size
+    if entry != remote_inf:
+        manifest[file_name] = remote_inf
+        save_manifest(manifest_file, manifest)
+    if offset == size:
+        return False
+    print('Downloading {fi}'.format(fi=file_name))
+    retry_times = 0
+    while True:
+        try:
+            await get_file(pool, remote_inf['remote'], outfile,
+                           offset=offset)
+            break
+        except FTP_ERRORS as exc:
+            retry_times += 1
+            if retry_times > retry_lim:
+                raise
+            print('Download {fi} interrupted ({err}), retrying.'.format(
+                fi=file_name, err=exc))
+            offset = outfile.stat().st_size if outfile.exists() else 0
+            if offset > size:
+                offset = 0
+    print('Download {fi} finished.'.format(fi=file_name))
+    return True
 
 
 def download_ensembl_files(species_file, version,
-                           out_dir=CURRENT_DIR, test=False):
+                           out_dir=CURRENT_DIR, test=False,
+                           file_types=('pep',),
+                           workers=DEFAULT_CONCUR_FILES):
+    '''
+    keep `file_types` (cds, pep, gtf, dna) of the species in
+    `species_file` for Ensembl Plants release `version` in `out_dir`,
+    only files changed on the server (size or modify time against
+    the manifest in `out_dir`) or not fully downloaded are fetched.
+    '''
     species_df = pd.read_table(species_file, header=None,
                                names=['species'])
 
@@ -104,31 +192,82 @@ def download_ensembl_files(species_file, version,
 
     species_df.loc[:, 'species'] = species_df.species.map(format_sp)
 
+    if isinstance(file_types, str):
+        file_types = file_types.split(',')
+    unknown_types = set(file_types) - set(FILE_TYPES)
+    if unknown_types:
+        raise ValueError(f'unknown file types: {unknown_types}')
+    if test:
+        file_types = ['test_file']
+
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = out_dir / MANIFEST_NAME
+    manifest = load_manifest(manifest_file)
+
     info_dict = dict()
     loop = asyncio.get_event_loop()
+    # logged-in connections are shared by listing and downloads
+    pool = FTPPool(HOST, PORT, size=workers)
+    list_dir = dir_lister(pool)
     inf_tasks = [
-        get_inf(HOST, each_sp, version, info_dict) for
+        get_inf(list_dir, each_sp, version, info_dict) for
         each_sp in species_df.species]
-    loop.run_until_complete(asyncio.wait(inf_tasks))
-
-    # file_type = ['cds', 'gtf']
-    file_type = ['pep']
-    if test:
-        file_type = ['test_file']
+    # a species failing to list (550 for a missing directory) does not
+    # stop the others
+    inf_results = loop.run_until_complete(
+        asyncio.gather(*inf_tasks, return_exceptions=True))
 
     file_list = list()
-    for each_sp in species_df.species:
+    for each_sp, each_result in zip(species_df.species, inf_results):
+        if isinstance(each_result, Exception):
+            print('Listing {sp} failed: {err}'.format(
+                sp=each_sp, err=each_result))
+            continue
+        if each_sp not in info_dict:
+            print('{sp} not found in release {ver}.'.format(
+                sp=each_sp, ver=version))
+            continue
         each_sp_gv = info_dict[each_sp]
         each_sp_files = ensembl_file_path(each_sp, each_sp_gv,
                                           version)
-        for each_file in file_type:
+        for each_file in file_types:
             file_list.append(each_sp_files[each_file])
 
-    download_tasks = [
-        get_file(HOST, each_path) for each_path
-        in file_list]
-    loop.run_until_complete(asyncio.wait(download_tasks))
+    remote_infs = loop.run_until_complete(asyncio.gather(*[
+        get_remote_inf(list_dir, each_path) for each_path in file_list],
+        return_exceptions=True))
+    sync_tasks = list()
+    sync_names = list()
+    for each_path, each_inf in zip(file_list, remote_infs):
+        if isinstance(each_inf, Exception):
+            print('Listing {fi} failed: {err}'.format(
+                fi=each_path, err=each_inf))
+            continue
+        if each_inf is None:
+            print('{fi} not exists!'.format(fi=each_path))
+            continue
+        sync_names.append(pathlib.PurePosixPath(each_inf['remote']).name)
+        sync_tasks.append(sync_file(pool, each_inf, out_dir,
+                                    manifest, manifest_file))
+    # one file failing after its retries does not stop the others
+    sync_results = loop.run_until_complete(
+        asyncio.gather(*sync_tasks, return_exceptions=True))
+    pool.close()
     loop.close()
+    counts = {'downloaded': 0, 'up to date': 0, 'failed': 0}
+    for each_name, each_result in zip(sync_names, sync_results):
+        if isinstance(each_result, Exception):
+            print('Download {fi} failed: {err}'.format(
+                fi=each_name, err=each_result))
+            counts['failed'] += 1
+        elif each_result:
+            counts['downloaded'] += 1
+        else:
+            counts['up to date'] += 1
+    print('{dl} files downloaded, {ud} up to date, {fl} failed.'.format(
+        dl=counts['downloaded'], ud=counts['up to date'],
+        fl=counts['failed']))
 
 
 if __name__ == '__main__':
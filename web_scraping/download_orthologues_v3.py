@@ -1,19 +1,28 @@
-#import sys
+import sys
 import click
 import os
 import pandas as pd
 import numpy as np
+import asyncio
+import aiohttp
+import textwrap
 from collections import OrderedDict
 from Bio import SeqIO
-from rest_api import EnsemblRestClient
+from tqdm import tqdm
+from rest_api_asyncio import AsyncEnsemblClient, RateLimiter
 
 
 SERVER = "https://rest.ensemblgenomes.org"
+DEFAULT_REQS_PER_SEC = 15
+DEFAULT_WORKERS = 10
 
 
-def get_ensembl_seq(ensembl_id):
-    client = EnsemblRestClient(server=SERVER)
-    return client.get_seq(ensembl_id)
+def seq_obj_to_fasta(seq_obj, line_width=60):
+    header = seq_obj['id']
+    if seq_obj.get('desc'):
+        header = '{0} {1}'.format(header, seq_obj['desc'])
+    return '>{0}\n{1}\n'.format(
+        header, '\n'.join(textwrap.wrap(seq_obj['seq'], line_width)))
 
 
 def homology_json_to_df(ensembl_id, homo_inf):
@@ -37,16 +46,101 @@ def homology_json_to_df(ensembl_id, homo_inf):
     return homo_df
 
 
-def get_ensembl_orthologues(ensembl_id):
-    client = EnsemblRestClient(server=SERVER)
-    decoded = client.get_orthologues(ensembl_id)
+async def get_ensembl_orthologues(client, ensembl_id):
+    '''
+    orthologue table of `ensembl_id`, None if the request failed
+    '''
+    try:
+        decoded = await client.get_orthologues(ensembl_id)
+    except aiohttp.ClientResponseError as exc:
+        sys.stderr.write(f'Orthologues of {ensembl_id} failed: '
+                         f'{exc.status} {exc.message}\n')
+        return None
+    if decoded is None:
+        return None
     try:
         homo_inf = decoded['data'][0]['homologies']
-    except IndexError:
+    except (IndexError, KeyError):
         homo_inf = None
     return homology_json_to_df(ensembl_id, homo_inf)
 
 
+async def download_orthologues(client, ens_ids, id_map_df, meta_file,
+                               workers):
+    '''
+    orthologues of `ens_ids`, `workers` requests in flight (paced by the
+    client limiter), rows are appended to `meta_file` as genes finish
+    so an interrupted download resumes from the last finished gene.
+    genes whose request failed are not written and retried next run,
+    their number is returned.
+    '''
+    failed = 0
+    ens_id_queue = asyncio.Queue()
+    for each_id in ens_ids:
+        ens_id_queue.put_nowait(each_id)
+    write_header = not (os.path.exists(meta_file) and
+                        os.stat(meta_file).st_size)
+    progress = tqdm(total=len(ens_ids), ncols=100, desc='Othologues')
+    with open(meta_file, 'a') as meta_file_inf:
+
+        async def worker():
+            nonlocal write_header, failed
+            while not ens_id_queue.empty():
+                each_id = ens_id_queue.get_nowait()
+                each_id_orth_df = await get_ensembl_orthologues(
+                    client, each_id)
+                progress.update()
+                if each_id_orth_df is None:
+                    failed += 1
+                    continue
+                each_id_orth_df = pd.merge(
+                    id_map_df, each_id_orth_df,
+                    left_index=True, right_index=True)
+                each_id_orth_df.index.name = 'Ensembl_id'
+                each_id_orth_df.to_csv(meta_file_inf, sep='\t',
+                                       header=write_header,
+                                       na_rep='None')
+                write_header = False
+
+        await asyncio.gather(*[worker() for _ in range(workers)])
+    progress.close()
+    return failed
+
+
+async def download_seqs(client, ens_ids, seq_file, in_flight):
+    '''
+    sequences of `ens_ids` by batched POST requests, written to
+    `seq_file` as each batch returns. IDs of failed batches are not
+    written and returned, they are retried next run.
+    '''
+    failed_ids = []
+    ens_id_queue = asyncio.Queue()
+    for each_id in ens_ids:
+        ens_id_queue.put_nowait(each_id)
+    progress = tqdm(total=len(ens_ids), ncols=100, desc='Sequences')
+    with open(seq_file, 'a') as seq_file_inf:
+
+        async def worker():
+            while not ens_id_queue.empty():
+                each_id = ens_id_queue.get_nowait()
+                try:
+                    seq_obj = await client.fetch_seq(each_id)
+                except aiohttp.ClientError as exc:
+                    # the whole batch failed, every ID of it gets here
+                    sys.stderr.write(f'Sequence of {each_id} failed: '
+                                     f'{exc}\n')
+                    seq_obj = None
+                progress.update()
+                if seq_obj is None:
+                    failed_ids.append(each_id)
+                elif seq_obj:
+                    seq_file_inf.write(seq_obj_to_fasta(seq_obj))
+
+        await asyncio.gather(*[worker() for _ in range(in_flight)])
+    progress.close()
+    return failed_ids
+
+
 @click.command()
 @click.argument(
     'id_map',
@@ -58,7 +152,19 @@ def get_ensembl_orthologues(ensembl_id):
     type=click.Path(file_okay=False),
     default=os.getcwd()
 )
-def main(id_map, out_dir):
+@click.option(
+    '--reqs_per_sec',
+    default=DEFAULT_REQS_PER_SEC,
+    type=click.FLOAT,
+    help='request rate limit of Ensembl REST server.'
+)
+@click.option(
+    '--workers',
+    default=DEFAULT_WORKERS,
+    type=click.INT,
+    help='orthologue requests in flight.'
+)
+def main(id_map, out_dir, reqs_per_sec, workers):
     # check out_dir existence
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
@@ -71,6 +177,10 @@ def main(id_map, out_dir):
     else:
         meta_df = pd.DataFrame([])
 
+    loop = asyncio.get_event_loop()
+    client = AsyncEnsemblClient(server=SERVER,
+                                limiter=RateLimiter(reqs_per_sec))
+
     # read ensembl ids
     id_map_df = pd.read_table(id_map, header=None, index_col=1,
                               names=['Protein_id'])
@@ -82,22 +192,11 @@ def main(id_map, out_dir):
         orthologues_dl_df = pd.read_table(download_table, index_col=0)
     else:
         # start to fetch othologues information
-        for each_id in ens_id_obj:
-            each_id_orth_df = get_ensembl_orthologues(each_id)
-            each_id_orth_df = pd.merge(
-                id_map_df, each_id_orth_df,
-                left_index=True, right_index=True)
-            meta_df = pd.concat([meta_df, each_id_orth_df])
-            with open(meta_file, 'a') as meta_file_inf:
-                for i in range(len(each_id_orth_df)):
-                    meta_file_inf.write('{ei}\t{pi}\t{ot}\t{tp}\t{qp}\n'.format(
-                        ei=each_id, pi=each_id_orth_df.ix[i][0],
-                        ot=each_id_orth_df.ix[i][1],
-                        tp=each_id_orth_df.ix[i][2],
-                        qp=each_id_orth_df.ix[i][3]))
-        orthologues_df = meta_df
-        orthologues_df.index.name = 'Ensembl_id'
-        orthologues_df.to_csv(meta_file, sep='\t', na_rep='None')
+        failed = loop.run_until_complete(download_orthologues(
+            client, ens_id_obj, id_map_df, meta_file, workers))
+        if failed:
+            print(f'{failed} genes failed, run again to retry them.')
+        orthologues_df = pd.read_table(meta_file, index_col=0)
 
         # filter identify cutoff > 60
         orthologues_dl_df = orthologues_df.dropna()
@@ -121,12 +220,21 @@ def main(id_map, out_dir):
     if left_seq_obj.empty:
         print('Othologues sequence download finished!')
     else:
-        genomic_seq_inf = open(genomic_seq_file, 'a')
-        for each_id in left_seq_obj.unique():
-            ensembl_seq = get_ensembl_seq(each_id)
-            if ensembl_seq:
-                genomic_seq_inf.write(ensembl_seq)
-        genomic_seq_inf.close()
+        # pending IDs fill whole POST batches
+        failed_ids = loop.run_until_complete(download_seqs(
+            client, left_seq_obj.unique(), genomic_seq_file,
+            workers * client.seq_batcher.batch_size))
+        failed_file = os.path.join(out_dir, 'failed_seq_ids.txt')
+        if failed_ids:
+            pd.Series(failed_ids).to_csv(failed_file, index=False,
+                                         header=False)
+            print(f'{len(failed_ids)} sequences failed, listed in '
+                  f'{failed_file}, run again to retry them.')
+        elif os.path.exists(failed_file):
+            os.remove(failed_file)
+    loop.run_until_complete(client.close())
+    print(client.limiter.rate_stats)
+    loop.close()
 
 
 if __name__ == '__main__':
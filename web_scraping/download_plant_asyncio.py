@@ -8,28 +8,59 @@ import urllib.parse
 import pathlib
 import asyncio
 import aiohttp
-import time
+import os
+from rest_api_asyncio import RateLimiter
 
 
 URL = 'http://cantata.amu.edu.pl/download.php'
 CURRENT_DIR = pathlib.Path().cwd()
 
-SEMA = asyncio.Semaphore(5)
+DEFAULT_WORKERS = 5
+# politeness: requests started per second on each host
+DEFAULT_REQS_PER_SEC = 0.5
+CHUNK_SIZE = 64 * 1024
 
 
-async def get_file(url, res_dict):
-    with (await SEMA):
-        async with aiohttp.ClientSession() as session:
+async def get_file(url, out_file, session, semaphore, limiter):
+    '''
+    stream `url` to a temporary file next to `out_file` chunk by chunk,
+    it is renamed to `out_file` only when the download is complete.
+    '''
+    file_name = pathlib.PurePath(url).name
+    part_file = pathlib.Path(f'{out_file}.part')
+    async with semaphore:
+        # waits without blocking the other downloads
+        await limiter.acquire(url)
+        print('Downloading {n}...'.format(n=file_name))
+        try:
             async with session.get(url) as resp:
-                file_name = pathlib.PurePath(url).name
-                print('Downloading {n}...'.format(n=file_name))
-                url_content = await resp.text()
-                res_dict[url] = url_content
-                time.sleep(10)
+                resp.raise_for_status()
+                with open(part_file, 'wb') as part_inf:
+                    async for chunk in resp.content.iter_chunked(
+                            CHUNK_SIZE):
+                        part_inf.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            print('Failed to download {n}: {e}'.format(n=file_name, e=exc))
+            if part_file.exists():
+                part_file.unlink()
+            return False
+    os.replace(part_file, out_file)
+    return True
+
+
+async def get_files(href_dict, workers, reqs_per_sec):
+    semaphore = asyncio.Semaphore(workers)
+    limiter = RateLimiter(reqs_per_sec)
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*[
+            get_file(each_url, each_file, session, semaphore, limiter)
+            for each_url, each_file in href_dict.items()])
 
 
 def download_files(out_dir=CURRENT_DIR,
-                   url=URL):
+                   url=URL,
+                   workers=DEFAULT_WORKERS,
+                   reqs_per_sec=DEFAULT_REQS_PER_SEC):
     r = requests.get(url)
     soup = BeautifulSoup(r.content, 'lxml')
     download_hrefs = soup.find(
@@ -48,18 +79,14 @@ def download_files(out_dir=CURRENT_DIR,
             ))
         else:
             href_dict[each_url] = each_file
-    res_dict = dict()
     if href_dict:
-        tasks = [get_file(host, res_dict) for host in href_dict]
-        # # for test
-        # tasks = tasks[:8]
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.wait(tasks))
-        for each_url in res_dict:
-            each_file = href_dict[each_url]
-            each_content = res_dict[each_url]
-            with open(each_file, 'w') as file_inf:
-                file_inf.write(each_content)
+        download_status = loop.run_until_complete(
+            get_files(href_dict, workers, reqs_per_sec))
+        loop.close()
+        failed_num = len(download_status) - sum(download_status)
+        if failed_num:
+            print('{n} files failed to download.'.format(n=failed_num))
     else:
         print('All file is downloaded.')
 
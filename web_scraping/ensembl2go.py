@@ -11,6 +11,11 @@ import glob
 import sys
 import urllib3
 
+# the table collapse lives with the other table helpers
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] /
+                       'bioinformatics' / 'format'))
+from format_table import collapse_df  # noqa: E402
+
 
 OUT_HEADER_BASE = [
     'gene_id',
@@ -33,20 +38,11 @@ OUT_HEADER_REF = [
 
 
 def format_df(gene_df, sep=',', empty_rep=None, by='gene_id'):
-
-    def my_unique(x, sep=','):
-        unique_x = pd.unique(x.dropna())
-        if str(unique_x.dtype) == 'float64':
-            unique_x = unique_x.astype('int')
-        unique_x = [str(each) for each in unique_x]
-        if not unique_x:
-            if empty_rep is None:
-                return None
-            else:
-                unique_x = [empty_rep]
-        return sep.join(unique_x)
-
-    gene_df = gene_df.groupby(by).agg(my_unique, sep)
+    '''
+    one row per `by` value, unique values of the other columns joined by
+    `sep` in order of appearance (format_table.collapse_df).
+    '''
+    gene_df = collapse_df(gene_df, by, sep=sep, empty_rep=empty_rep)
     return gene_df.reset_index()
 
 
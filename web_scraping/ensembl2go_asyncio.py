@@ -1,16 +1,22 @@
 import fire
-from rest_api_asyncio import UniprotClient, get_db
+from rest_api_asyncio import UniprotClient, get_db, retry_after_delay
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+from result_store import ResultStore
 import pandas as pd
 from pandas import DataFrame
 import gtfparse
 import time
 from tqdm import tqdm
 from pathlib import Path
-from functools import reduce
-import glob
 import sys
 import urllib3
 import asyncio
+import aiohttp
+
+# the table collapse lives with the other table helpers
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] /
+                       'bioinformatics' / 'format'))
+from format_table import collapse_df  # noqa: E402
 
 
 OUT_HEADER_BASE = [
@@ -35,55 +41,19 @@ OUT_HEADER_REF = [
 
 DEFAULT_CONCUR_REQ = 10
 DEFAULT_RETRY_TIMES = 2
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_LINGER = 0.05
 
 
 def format_df(gene_df, sep=',', empty_rep=None, by='gene_id'):
-
-    def my_unique(x, sep=','):
-        unique_x = pd.unique(x.dropna())
-        if str(unique_x.dtype) == 'float64':
-            unique_x = unique_x.astype('int')
-        unique_x = [str(each) for each in unique_x]
-        if not unique_x:
-            if empty_rep is None:
-                return None
-            else:
-                unique_x = [empty_rep]
-        return sep.join(unique_x)
-
-    gene_df = gene_df.groupby(by).agg(my_unique, sep)
+    '''
+    one row per `by` value, unique values of the other columns joined by
+    `sep` in order of appearance (format_table.collapse_df).
+    '''
+    gene_df = collapse_df(gene_df, by, sep=sep, empty_rep=empty_rep)
     return gene_df.reset_index()
 
 
-def save_download(df, middle_file):
-    middle_file = Path(middle_file)
-    if middle_file.exists():
-        write_mode = 'a'
-        write_header = False
-    else:
-        write_header = True
-        write_mode = 'w'
-    df.to_csv(middle_file, header=write_header,
-              mode=write_mode, index=False,
-              sep='\t')
-
-
-def save_download_to_dir(df, middle_file_dir, file_id):
-    middle_file_dir = Path(middle_file_dir)
-    middle_file_dir.mkdir(parents=True, exist_ok=True)
-    middle_file = middle_file_dir / f'{file_id}.txt'
-    df.to_csv(middle_file, index=False, sep='\t')
-
-
-def idlist2df(id_list, col_name, identity_map=None):
-    if id_list:
-        list_df = DataFrame(id_list, columns=[col_name])
-        if identity_map is not None:
-            for key, val in identity_map.items():
-                list_df.loc[:, key] = val
-        return list_df
-
-
 def refdb_anno(anno_db, db_name):
     db_ids = [each['id'] for each in anno_db
               if each['type'] == db_name]
@@ -132,118 +102,89 @@ def commentdb_anno(commentdb):
     return comment_db_dict
 
 
-def extract_anno_inf(decoded, uniprot_id, middle_file):
-    anno_dfs = list()
-    identity_map = {'uniprot_id': uniprot_id}
+def extract_anno_inf(decoded, uniprot_id, sep='|'):
+    '''
+    one flat record per UniProt entry, multiple values of a field are
+    joined by `sep` in order of appearance, duplicates removed.
+    '''
+    anno_inf = {'uniprot_id': uniprot_id}
+
+    def add_field(col_name, values):
+        if values:
+            anno_inf[col_name] = sep.join(
+                dict.fromkeys(str(each) for each in values))
+
     if 'gene' in decoded:
         gene_db = decoded['gene']
-        gene_names = [each['name']['value'] for each in gene_db
-                      if 'name' in each]
-        anno_dfs.append(idlist2df(gene_names, 'gene_names',
-                                  identity_map=identity_map))
+        add_field('gene_names', [each['name']['value'] for each in gene_db
+                                 if 'name' in each])
     if 'protein' in decoded:
         protein_db = decoded['protein']
-        products = None
         if 'submittedName' in protein_db:
-            products = [each['fullName']['value'] for
-                        each in protein_db['submittedName']
-                        if 'value' in each['fullName']]
+            add_field('protein_names', [each['fullName']['value'] for
+                                        each in protein_db['submittedName']
+                                        if 'value' in each['fullName']])
         elif 'recommendedName' in protein_db:
-            products = [protein_db['recommendedName']['fullName']['value']]
-        if products is not None:
-            anno_dfs.append(idlist2df(products, 'protein_names',
-                                      identity_map=identity_map))
+            add_field('protein_names',
+                      [protein_db['recommendedName']['fullName']['value']])
     if 'proteinExistence' in decoded:
-        anno_dfs.append(idlist2df([decoded['proteinExistence']],
-                                  'protein_existence',
-                                  identity_map=identity_map))
+        add_field('protein_existence', [decoded['proteinExistence']])
     if 'comments' in decoded:
-        comment_db = decoded['comments']
-        comment_db_dict = commentdb_anno(comment_db)
-        if comment_db_dict:
-            for key, val in comment_db_dict.items():
-                anno_dfs.append(idlist2df(val, key,
-                                          identity_map=identity_map))
+        for key, val in commentdb_anno(decoded['comments']).items():
+            add_field(key, val)
     if 'dbReferences' in decoded:
         anno_db = decoded['dbReferences']
         interpro_ids, interpro_names = refdb_anno(anno_db, 'InterPro')
-        if interpro_ids:
-            anno_dfs.append(idlist2df(interpro_ids, 'interpro_ids',
-                                      identity_map=identity_map))
-            anno_dfs.append(idlist2df(interpro_names, 'interpro_names',
-                                      identity_map=identity_map))
+        add_field('interpro_ids', interpro_ids)
+        add_field('interpro_names', interpro_names)
         pfam_ids, pfam_names = refdb_anno(anno_db, 'Pfam')
-        if pfam_ids:
-            anno_dfs.append(idlist2df(pfam_ids, 'pfam_ids',
-                                      identity_map=identity_map))
-            anno_dfs.append(idlist2df(pfam_names, 'pfam_names',
-                                      identity_map=identity_map))
+        add_field('pfam_ids', pfam_ids)
+        add_field('pfam_names', pfam_names)
     if 'features' in decoded:
-        feature_db = decoded['features']
-        feature_db_dict = featuredb_anno(feature_db)
-        if feature_db_dict:
-            for key, val in feature_db_dict.items():
-                anno_dfs.append(idlist2df(val, key,
-                                          identity_map=identity_map))
+        for key, val in featuredb_anno(decoded['features']).items():
+            add_field(key, val)
     if 'references' in decoded:
         citation_db = decoded['references']
-        pubmed_ids = [each['citation']['dbReferences'][0]['id']
-                      for each in citation_db
-                      if 'dbReferences' in each['citation']]
-        if pubmed_ids:
-            anno_dfs.append(idlist2df(pubmed_ids, 'pubmed_ids',
-                                      identity_map=identity_map))
-    if anno_dfs:
-        anno_dfs = [each for each in anno_dfs
-                    if each is not None]
-        anno_df = reduce(pd.merge, anno_dfs)
-    else:
-        anno_df = DataFrame([None], columns=['protein_existence'])
-        anno_df.loc[:, 'uniprot_id'] = uniprot_id
-    return anno_df
-
-
-async def go_anno_map(go_id, middle_file, client, semaphore, skip):
-    with await semaphore:
-        decoded = await client.get_go_anno(go_id)
-    go_df = DataFrame([go_id, None, None],
-                      index=['go_id', 'go_term', 'go_ontology']).T
+        add_field('pubmed_ids', [each['citation']['dbReferences'][0]['id']
+                                 for each in citation_db
+                                 if 'dbReferences' in each['citation']])
+    if len(anno_inf) == 1:
+        anno_inf['protein_existence'] = None
+    return anno_inf
+
+
+async def go_anno_map(go_id, client, semaphore, skip):
+    # terms are batched by the client, holding the semaphore here
+    # would cap a batch to the number of workers
+    decoded = await client.fetch_go_term(go_id)
     if decoded is None:
         if not skip:
             return None
-    for each_result in decoded['results']:
-        if each_result['id'] == go_id:
-            go_df = DataFrame([go_id,
-                               each_result['name'],
-                               each_result['aspect']],
-                              index=['go_id',
-                                     'go_term',
-                                     'go_ontology']).T
-    save_download(go_df, middle_file)
+        decoded = {}
+    go_df = DataFrame([go_id,
+                       decoded.get('name'),
+                       decoded.get('aspect')],
+                      index=['go_id',
+                             'go_term',
+                             'go_ontology']).T
     return go_df
 
 
-async def uniprot_go_map(uniprot_id, middle_file, client,
-                         semaphore, skip=False):
+async def uniprot_go_map(uniprot_id, client, semaphore, skip=False):
     '''
-    function to download go ids using uniport id
+    function to download go ids using uniport id,
+    page number is known from the first page, the other pages are
+    downloaded concurrently and kept in page order.
     '''
-    decoded_list = []
-
-    async def download_page_inf(uniprot_id, semaphore, page=1):
-        nonlocal client
-        nonlocal decoded_list
-        with await semaphore:
-            decoded = await client.get_go_inf(uniprot_id, page=page)
-        decoded_list.append(decoded)
-        if decoded is None:
-            return None
-        total_page = decoded['pageInfo']['total']
-        cur_page = decoded['pageInfo']['current']
-        if cur_page < total_page:
-            return await download_page_inf(uniprot_id, semaphore, cur_page + 1)
-
-    await download_page_inf(uniprot_id, semaphore)
+    async def download_page_inf(page):
+        async with semaphore:
+            return await client.get_go_inf(uniprot_id, page=page)
+
+    decoded_list = [await download_page_inf(1)]
+    if decoded_list[0] is not None:
+        total_page = decoded_list[0]['pageInfo']['total']
+        decoded_list.extend(await asyncio.gather(
+            *[download_page_inf(page) for page in range(2, total_page + 1)]))
     total_goids = []
     for decoded in decoded_list:
         if decoded is None:
@@ -260,124 +201,124 @@ async def uniprot_go_map(uniprot_id, middle_file, client,
     else:
         go_df = DataFrame([None], columns=['go_id'])
     go_df.loc[:, 'uniprot_id'] = uniprot_id
-    save_download(go_df, middle_file)
     return go_df
 
 
-async def uniprot_anno_map(uniprot_id, middle_file, client,
-                           semaphore, skip=False):
-    with await semaphore:
-        decoded = await client.get_protein_inf(uniprot_id)
+async def uniprot_anno_map(uniprot_id, client, semaphore, skip=False):
+    decoded = await client.fetch_protein(uniprot_id)
     if decoded is None:
         if not skip:
             return None
         else:
             decoded = {}
-    anno_df = extract_anno_inf(decoded, uniprot_id, middle_file)
-    anno_df = format_df(anno_df, sep='|', by='uniprot_id')
-    save_download_to_dir(anno_df, middle_file, uniprot_id)
-    return anno_df
+    return [extract_anno_inf(decoded, uniprot_id)]
 
 
-async def ens_anno_map(ensembl_id, middle_file, client,
-                       semaphore, skip=False):
-    with await semaphore:
+async def ens_anno_map(ensembl_id, client, semaphore, skip=False):
+    async with semaphore:
         decodeds = await client.get_gene_inf(ensembl_id)
-    anno_dfs = list()
+    anno_records = dict()
     if decodeds is not None:
         for decoded in decodeds:
             uniprot_id = decoded['accession']
-            anno_dfs.append(
-                extract_anno_inf(decoded, uniprot_id,
-                                 middle_file))
+            if uniprot_id not in anno_records:
+                anno_records[uniprot_id] = extract_anno_inf(decoded,
+                                                            uniprot_id)
     else:
         if not skip:
             return None
-    if anno_dfs:
-        anno_df = pd.concat(anno_dfs)
-        anno_df = format_df(anno_df, sep='|', by='uniprot_id')
-    else:
-        anno_df = DataFrame([None], columns=['uniprot_id'])
-    anno_df.loc[:, 'gene_id'] = ensembl_id
-    out_ensembl_id = ensembl_id.split(':')[-1]
-    save_download_to_dir(anno_df, middle_file, out_ensembl_id)
-    return anno_df
+    anno_records = list(anno_records.values())
+    if not anno_records:
+        anno_records = [{'uniprot_id': None}]
+    for each in anno_records:
+        each['gene_id'] = ensembl_id
+    return anno_records
 
 
 async def map2df(map_func, query_ids, msg,
                  middle_file, concur_req,
-                 retry_limits,
-                 id_col_name='uniprot_id',
-                 skip=False):
-    client = UniprotClient()
+                 retry_limits, client,
+                 in_flight=None):
+    '''
+    a fixed pool of `in_flight` (default: `concur_req`) workers takes
+    IDs from a bounded queue, so memory does not grow with the number
+    of IDs. A failed ID is retried by its worker with backoff up to
+    `retry_limits` times, the last try keeps partial results (skip).
+    offline, an ID missing in the cache is not retried and not stored,
+    so it is downloaded by the next online run.
+
+    results are kept in the `middle_file` store as they arrive,
+    IDs already in the store are not downloaded again.
+    '''
+    if in_flight is None:
+        in_flight = concur_req
     semaphore = asyncio.Semaphore(concur_req)
-    if middle_file.exists():
-        if middle_file.is_file():
-            finished_df = pd.read_table(middle_file)
-        elif middle_file.is_dir():
-            middle_files = glob.glob(f'{middle_file}/*txt')
-            finished_dfs = [pd.read_table(each_file) for each_file
-                            in middle_files]
-            finished_df = pd.concat(finished_dfs)
-        else:
-            sys.exit(f'unsupported file type of {middle_file}!')
-        left_ids = set(query_ids).difference(
-            set(finished_df.loc[:, id_col_name]))
-    else:
-        finished_df = DataFrame([])
-        left_ids = query_ids
-
-    map_dfs = list()
-    download_fail = 0
-    to_do = [map_func(each_id, middle_file, client, semaphore, skip)
-             for each_id in left_ids]
-    to_do_iter = asyncio.as_completed(to_do)
-    to_do_iter = tqdm(to_do_iter, total=len(left_ids),
-                      ncols=100, desc=f'{msg:<40}')
-    for future in to_do_iter:
-        try:
-            each_df = await future
-        except FetchError as exc:
-            country_code = exc.country_code
-            try:
-                error_msg = exc.__cause__.args[0]
-            except IndexError:
-                error_msg = exc.__cause__.__class__.__name__
-                msg = '*** Error for {}: {}'
-                print(msg.format(country_code, error_msg))
-                download_fail += 1
-        else:
-            if each_df is None:
-                download_fail += 1
+    store = ResultStore(middle_file)
+    left_ids = store.left_ids(query_ids)
+    store.start()
+    id_queue = asyncio.Queue(maxsize=in_flight * 2)
+    progress = tqdm(total=len(left_ids), ncols=100, desc=f'{msg:<40}')
+    counts = {'failed': 0, 'retried': 0}
+    offline = client.cache is not None and client.cache.offline
+    if offline:
+        counts['uncached'] = 0
+
+    async def producer():
+        for each_id in left_ids:
+            await id_queue.put(each_id)
+        for _ in range(in_flight):
+            await id_queue.put(None)
+
+    async def worker():
+        while True:
+            each_id = await id_queue.get()
+            if each_id is None:
+                return
+            for tried in range(retry_limits + 1):
+                skip = tried == retry_limits
+                try:
+                    each_result = await map_func(each_id, client, semaphore,
+                                                 skip)
+                except aiohttp.ClientError as exc:
+                    sys.stderr.write(f'*** Error for {each_id}: {exc}\n')
+                    each_result = None
+                if each_result is not None:
+                    # waits here when the writer falls behind
+                    await store.put(each_id, each_result)
+                    break
+                if offline:
+                    counts['uncached'] += 1
+                    break
+                if not skip:
+                    counts['retried'] += 1
+                    await asyncio.sleep(retry_after_delay(None, tried))
             else:
-                map_dfs.append(each_df)
-    if download_fail > 0 and retry_limits > 0:
-        print(f'{download_fail} items failed to download.')
-        print(f'last {retry_limits} try!')
-        retry_limits = retry_limits - 1
-        if retry_limits == 1:
-            skip = True
-        return await map2df(map_func, query_ids, msg,
-                            middle_file, concur_req,
-                            retry_limits,
-                            id_col_name=id_col_name,
-                            skip=skip)
-    if map_dfs:
-        map_df = pd.concat(map_dfs)
-        map_df = pd.concat([finished_df, map_df])
-    else:
-        map_df = finished_df
+                counts['failed'] += 1
+            progress.set_postfix(counts, refresh=False)
+            progress.update()
+
+    await asyncio.gather(producer(),
+                         *[worker() for _ in range(in_flight)])
+    progress.close()
+    await store.stop()
+    if counts['failed'] > 0:
+        print(f'{counts["failed"]} items failed to download.')
+    if counts.get('uncached'):
+        print(f'{counts["uncached"]} items not in the cache, '
+              'run online to download them.')
+    map_df = store.to_df()
+    store.close()
     return map_df
 
 
 def map2df_summary(map_func, query_ids, msg,
                    middle_file, concur_req,
-                   retry_limits, loop,
-                   id_col_name='uniprot_id'):
+                   retry_limits, loop, client,
+                   in_flight=None):
     coro = map2df(map_func, query_ids, msg,
                   middle_file, concur_req,
-                  retry_limits,
-                  id_col_name=id_col_name)
+                  retry_limits, client,
+                  in_flight=in_flight)
     df = loop.run_until_complete(coro)
     return df
 
@@ -402,13 +343,24 @@ def format_uniprot_anno(ens_anno_df, anno_file):
 
 
 def go_annotation(input_file, species=None, workers=DEFAULT_CONCUR_REQ,
-                  retry=DEFAULT_RETRY_TIMES):
+                  retry=DEFAULT_RETRY_TIMES, batch_size=DEFAULT_BATCH_SIZE,
+                  linger=DEFAULT_BATCH_LINGER, cache_file=DEFAULT_CACHE_FILE,
+                  no_cache=False, offline=False):
     input_file = Path(input_file)
     anno_file = input_file.with_suffix('.anno.txt')
     gene_list_file = input_file.with_suffix('.pcg.gene.list')
-    ens_uni_map_file = input_file.with_suffix('.uni_id.map')
+    ens_uni_map_file = input_file.with_suffix('.uni_id.sqlite')
     ens_anno_map_df = None
     loop = asyncio.get_event_loop()
+    # keep-alive connections are shared by all steps
+    # responses are shared with other projects through the cache
+    cache = None
+    if not no_cache:
+        cache = ResponseCache(cache_file, offline=offline)
+    client = UniprotClient(limit_per_host=workers,
+                           batch_size=batch_size,
+                           batch_linger=linger,
+                           cache=cache)
 
     if input_file.suffix == '.gtf':
         # need species info to choose ensembl sever
@@ -434,8 +386,7 @@ def go_annotation(input_file, species=None, workers=DEFAULT_CONCUR_REQ,
         map_gene_id_msg = 'Mapping ensembl id <-> uniprot annotation'
         ens_anno_df = map2df_summary(ens_anno_map, gtf_genes,
                                      map_gene_id_msg, ens_uni_map_file,
-                                     workers, retry, loop,
-                                     id_col_name='gene_id')
+                                     workers, retry, loop, client)
         ens_anno_df.loc[:, 'gene_id'] = ens_anno_df.gene_id.map(rm_db_name)
         ens_uni_map_df = ens_anno_df.loc[
             :, ['gene_id', 'uniprot_id']].dropna()
@@ -448,24 +399,25 @@ def go_annotation(input_file, species=None, workers=DEFAULT_CONCUR_REQ,
             swissprot_id_from_fa))
         # uniprot to annotation
         uni_anno_map_msg = 'Retriving UniProt annotation'
-        uni_anno_map_file = input_file.with_suffix('.uni_anno.map')
+        uni_anno_map_file = input_file.with_suffix('.uni_anno.sqlite')
         uni_anno_map_df = map2df_summary(uniprot_anno_map,
                                          ens_uni_map_df.uniprot_id.unique(),
                                          uni_anno_map_msg,
-                                         ens_uni_map_file,
+                                         uni_anno_map_file,
                                          workers, retry,
-                                         loop)
+                                         loop, client,
+                                         in_flight=workers * batch_size)
         ens_anno_df = ens_uni_map_df.merge(
             uni_anno_map_df)
     # uniprot to go
     go_file = input_file.with_suffix('.go.txt')
     map_uni_to_go_msg = 'Retriving GO ids'
-    uni_go_map_file = input_file.with_suffix('.uni_go.map')
+    uni_go_map_file = input_file.with_suffix('.uni_go.sqlite')
     uni_go_map_df = map2df_summary(uniprot_go_map,
                                    ens_uni_map_df.uniprot_id.unique(),
                                    map_uni_to_go_msg,
                                    uni_go_map_file,
-                                   workers, retry, loop)
+                                   workers, retry, loop, client)
     if not go_file.exists():
         uni_go_map_df.dropna(inplace=True)
         ens_go_df = ens_uni_map_df.merge(
@@ -474,18 +426,24 @@ def go_annotation(input_file, species=None, workers=DEFAULT_CONCUR_REQ,
         formated_go = format_df(ens_go_df)
         formated_go.to_csv(go_file, sep='\t',
                            header=False, index=False)
-    go_anno_map_file = input_file.with_suffix('.go_anno.map')
+    go_anno_map_file = input_file.with_suffix('.go_anno.sqlite')
     map_go_to_anno_msg = 'Retriving GO information'
     go_anno_map_df = map2df_summary(go_anno_map,
                                     uni_go_map_df.go_id.unique(),
                                     map_go_to_anno_msg,
                                     go_anno_map_file,
-                                    workers, retry, loop,
-                                    id_col_name='go_id')
+                                    workers, retry, loop, client,
+                                    in_flight=workers * batch_size)
     go_anno_map_df = go_anno_map_df.merge(uni_go_map_df)
     ens_anno_df = ens_anno_df.merge(go_anno_map_df)
     ens_anno_df = format_df(ens_anno_df, empty_rep='--', sep='|')
     format_uniprot_anno(ens_anno_df, anno_file)
+    loop.run_until_complete(client.close())
+    print(client.conn_stats)
+    print(client.limiter.rate_stats)
+    if cache is not None:
+        print(cache.cache_stats)
+        cache.close()
     loop.close()
 
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import pathlib
+import asyncio
+import aioftp
+import contextlib
+
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_SOCKET_TIMEOUT = 30
+# servers drop idle control connections, older clients are not reused
+DEFAULT_MAX_IDLE = 60
+DEFAULT_LISTING_FILE = os.environ.get(
+    'OMS_FTP_LISTING_CACHE',
+    str(pathlib.Path.home() / '.cache' / 'omsCabinet' / 'ftp_listing.json'))
+DEFAULT_LISTING_TTL = 6 * 3600
+
+
+class FTPPool(object):
+    '''
+    logged-in aioftp clients of one host, reused across files so each
+    transfer does not pay for the connect and login round trips.
+    At most `size` clients are in use at the same time.
+
+    directory listings are kept in `listing_file` for `listing_ttl`
+    seconds, repeated runs do not list the server again.
+    '''
+
+    def __init__(self, host, port=21, size=DEFAULT_POOL_SIZE,
+                 socket_timeout=DEFAULT_SOCKET_TIMEOUT,
+                 max_idle=DEFAULT_MAX_IDLE,
+                 listing_file=DEFAULT_LISTING_FILE,
+                 listing_ttl=DEFAULT_LISTING_TTL):
+        self.host = host
+        self.port = port
+        self.socket_timeout = socket_timeout
+        self.max_idle = max_idle
+        self.listing_file = pathlib.Path(listing_file)
+        self.listing_ttl = listing_ttl
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.discarded = set()
+        self.new_clients = 0
+        self.reused_clients = 0
+
+    async def _connect(self):
+        client = aioftp.Client(socket_timeout=self.socket_timeout)
+        try:
+            await client.connect(self.host, self.port)
+            await client.login()
+        except BaseException:
+            client.close()
+            raise
+        self.new_clients += 1
+        return client
+
+    def _idle_client(self):
+        while self.idle:
+            client, idle_since = self.idle.pop()
+            if time.monotonic() - idle_since < self.max_idle:
+                self.reused_clients += 1
+                return client
+            client.close()
+        return None
+
+    @contextlib.asynccontextmanager
+    async def client(self):
+        '''
+        a logged-in client, back to the pool when the block exits
+        normally and closed when it raises.
+        '''
+        async with self.slots:
+            client = self._idle_client() or await self._connect()
+            try:
+                yield client
+            except BaseException:
+                self.discard(client)
+                self.discarded.discard(id(client))
+                raise
+            if id(client) in self.discarded:
+                self.discarded.remove(id(client))
+            else:
+                self.idle.append((client, time.monotonic()))
+
+    def discard(self, client):
+        '''
+        close a client left in an unknown state, it is not reused
+        '''
+        client.close()
+        self.discarded.add(id(client))
+
+    def _load_listing(self):
+        if self.listing_file.exists():
+            with open(self.listing_file) as listing_inf:
+                return json.load(listing_inf)
+        return {}
+
+    def _save_listing(self, listing):
+        self.listing_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.listing_file.with_name(
+            f'{self.listing_file.name}.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as tmp_inf:
+            json.dump(listing, tmp_inf)
+        os.replace(tmp_file, self.listing_file)
+
+    async def list(self, path, refresh=False):
+        '''
+        [(path, info)] of the files in a remote directory
+        '''
+        key = f'{self.host}:{self.port}{path}'
+        listing = self._load_listing()
+        cached = listing.get(key)
+        if (cached is not None and not refresh and
+                time.time() - cached['time'] < self.listing_ttl):
+            return [(pathlib.PurePosixPath(each_path), info)
+                    for each_path, info in cached['entries']]
+        async with self.client() as client:
+            entries = await client.list(path)
+        listing = self._load_listing()
+        listing[key] = {'time': time.time(),
+                        'entries': [(str(each_path), info)
+                                    for each_path, info in entries]}
+        self._save_listing(listing)
+        return entries
+
+    def close(self):
+        for client, _ in self.idle:
+            client.close()
+        self.idle = []
+
+    @property
+    def conn_stats(self):
+        return f'{self.new_clients} new FTP connections, ' \
+            f'{self.reused_clients} reused FTP connections'
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import urllib.parse
+from pathlib import Path
+
+
+DEFAULT_CACHE_FILE = os.environ.get(
+    'OMS_REST_CACHE',
+    str(Path.home() / '.cache' / 'omsCabinet' / 'rest_cache.sqlite'))
+DEFAULT_CACHE_TTL = 30 * 24 * 3600
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+EVICT_RATIO = 0.9
+# eviction only needs a rough order, a hit is not written back to the
+# file when the entry was used within this many seconds
+ACCESS_RESOLUTION = 3600
+
+
+def normalize_url(url):
+    '''
+    same request, same key: lower case scheme and host,
+    query parameters sorted.
+    '''
+    url_parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode(sorted(
+        urllib.parse.parse_qsl(url_parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((url_parts.scheme.lower(),
+                                    url_parts.netloc.lower(),
+                                    url_parts.path, query, ''))
+
+
+class ResponseCache(object):
+    '''
+    decoded REST responses in a SQLite file shared by all projects,
+    keyed by normalized url and response format.
+
+    entries older than `ttl` seconds are downloaded again, least
+    recently used entries are dropped when the file grows over
+    `max_size` bytes. In `offline` mode nothing is downloaded and
+    expired entries are still served.
+    '''
+
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, ttl=DEFAULT_CACHE_TTL,
+                 max_size=DEFAULT_CACHE_SIZE, offline=False):
+        self.cache_file = Path(cache_file)
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(str(self.cache_file),
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                          'key TEXT PRIMARY KEY, url TEXT, body TEXT, '
+                          'size INTEGER, created REAL, accessed REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                          'ON responses (accessed)')
+        self.conn.commit()
+        self.total_size = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def cache_key(url, data_format):
+        key_str = f'{data_format} {normalize_url(url)}'
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    def get(self, url, data_format='application/json'):
+        '''
+        cached response of url, None if missing or expired
+        '''
+        key = self.cache_key(url, data_format)
+        row = self.conn.execute(
+            'SELECT body, created, accessed FROM responses WHERE key = ?',
+            (key,)).fetchone()
+        now = time.time()
+        if row is None or (not self.offline and now - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        if now - row[2] > ACCESS_RESOLUTION:
+            self.conn.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                (now, key))
+            self.conn.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, url, data, data_format='application/json'):
+        key = self.cache_key(url, data_format)
+        body = json.dumps(data)
+        now = time.time()
+        old_row = self.conn.execute(
+            'SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        if old_row is not None:
+            self.total_size -= old_row[0]
+        self.conn.execute('INSERT OR REPLACE INTO responses '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          (key, url, body, len(body), now, now))
+        self.total_size += len(body)
+        if self.total_size > self.max_size:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        '''
+        drop least recently used entries until the cache is 10% below
+        its size limit, so the next writes do not evict again.
+        '''
+        target_size = self.max_size * EVICT_RATIO
+        lru_rows = self.conn.execute(
+            'SELECT key, size FROM responses ORDER BY accessed')
+        drop_keys = []
+        for key, size in lru_rows:
+            if self.total_size <= target_size:
+                break
+            drop_keys.append((key,))
+            self.total_size -= size
+        self.conn.executemany('DELETE FROM responses WHERE key = ?',
+                              drop_keys)
+
+    @property
+    def cache_stats(self):
+        return f'{self.hits} cache hits, {self.misses} cache misses'
+
+    def close(self):
+        self.conn.close()
@@ -5,8 +5,10 @@ import urllib
 import urllib3
 import requests
 import time
+import random
 import asyncio
 import aiohttp
+from email.utils import parsedate_to_datetime
 
 
 GENE_SERVERS_DICT = {
@@ -14,6 +16,22 @@ GENE_SERVERS_DICT = {
     'https://rest.ensemblgenomes.org': 'EnsemblPlants'
 }
 
+DEFAULT_CONN_LIMIT = 100
+DEFAULT_CONN_LIMIT_PER_HOST = 20
+DEFAULT_DNS_CACHE_TTL = 300
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+
+RETRY_STATUS = (429, 503)
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_LINGER = 0.05
+# most IDs Ensembl REST takes in one POST request
+ENSEMBL_SEQ_POST_MAX = 50
+ENSEMBL_LOOKUP_POST_MAX = 1000
+
 
 def get_db(species):
     for each_server in GENE_SERVERS_DICT:
@@ -25,6 +43,179 @@ def get_db(species):
     sys.exit(f'{species} not found in Ensembl.')
 
 
+def retry_after_delay(retry_after, attempt):
+    '''
+    seconds to wait before retry `attempt` (from 0): Retry-After
+    (seconds or http date) if the server sent one, otherwise exponential
+    backoff, both with jitter so waiting coroutines do not come back
+    at the same moment.
+    '''
+    backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    if retry_after is None:
+        return random.uniform(0, backoff)
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(retry_after).timestamp() -
+                     time.time())
+        except (TypeError, ValueError):
+            delay = backoff
+    return max(delay, 0) + random.uniform(0, BACKOFF_BASE)
+
+
+class TokenBucket(object):
+    '''
+    asyncio token bucket: `rate` requests per second with bursts up to
+    `capacity`, waiting coroutines are served in order.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # a bucket must hold one token, also for rates below 1/s
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+        self.started = None
+        self.acquired = 0
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.tokens -= 1
+            if self.started is None:
+                self.started = now
+            self.acquired += 1
+
+    def pause(self, delay):
+        '''
+        stop handing out tokens for `delay` seconds, eg: after 429,
+        refilled tokens are dropped so requests resume at `rate`.
+        '''
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.updated = self.paused_until
+        self.tokens = 0
+
+    @property
+    def achieved_rate(self):
+        if self.started is None:
+            return 0
+        elapsed = time.monotonic() - self.started
+        return self.acquired / elapsed if elapsed > 0 else 0
+
+
+class RateLimiter(object):
+    '''
+    token buckets per host, shared by all coroutines (and clients)
+    using the limiter, `host_rates` overrides the default budget
+    of some hosts, eg: {'www.ebi.ac.uk': 20}.
+    '''
+
+    def __init__(self, reqs_per_sec=15, host_rates=None):
+        self.reqs_per_sec = reqs_per_sec
+        self.host_rates = host_rates or {}
+        self.buckets = {}
+
+    def bucket(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(
+                self.host_rates.get(host, self.reqs_per_sec))
+        return self.buckets[host]
+
+    async def acquire(self, url):
+        await self.bucket(url).acquire()
+
+    def backoff(self, url, delay):
+        self.bucket(url).pause(delay)
+
+    @property
+    def rate_stats(self):
+        return ', '.join(f'{host}: {bucket.achieved_rate:.1f} req/s'
+                         for host, bucket in self.buckets.items())
+
+
+class BatchRequester(object):
+    '''
+    coalesce single-ID lookups into batch requests: IDs wait until
+    `batch_size` of them are pending or the first one has waited
+    `linger` seconds, then `fetch_batch(ids)` is called once.
+
+    `fetch_batch` returns {id: result} or None if the request failed,
+    every caller gets the result of its own ID, {} if the ID is not in
+    a successful response and None if the request failed.
+    '''
+
+    def __init__(self, fetch_batch, batch_size=DEFAULT_BATCH_SIZE,
+                 linger=DEFAULT_BATCH_LINGER):
+        self.fetch_batch = fetch_batch
+        self.batch_size = batch_size
+        self.linger = linger
+        self.pending = {}
+        self.flush_handle = None
+        self.batch_num = 0
+        # running batches, referenced until they finish
+        self.tasks = set()
+
+    async def get(self, item_id):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.setdefault(item_id, []).append(future)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.linger, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.pending:
+            batch, self.pending = self.pending, {}
+            self.batch_num += 1
+            task = asyncio.ensure_future(self._fetch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _fetch(self, batch):
+        # a caller may be gone (cancelled, timed out) before its
+        # batch returns, the others still get their results
+        try:
+            results = await self.fetch_batch(list(batch))
+        except asyncio.CancelledError:
+            for futures in batch.values():
+                for future in futures:
+                    future.cancel()
+            raise
+        except Exception as exc:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(exc)
+            return
+        for item_id, futures in batch.items():
+            if results is None:
+                result = None
+            else:
+                result = results.get(item_id, {})
+            for future in futures:
+                if not future.done():
+                    future.set_result(result)
+
+
 class EnsemblRestClient(object):
     def __init__(self, server='http://rest.ensembl.org', reqs_per_sec=15):
         self.reqs_per_sec = reqs_per_sec
@@ -115,29 +306,88 @@ class EnsemblRestClient(object):
         return uniprot_obj
 
 
-class UniprotClient(object):
+class AsyncRestClient(object):
     '''
-    class to use EMBL-EBI API to download protein & go annotation
-
-    >>> client = UniprotClient()
-
-    test download go annotation
-    >>> go_anno_obj = client.get_go_anno('GO:0008150')
-    >>> go_anno_obj['results'][0]['id'] == 'GO:0008150'
-    True
-    >>> go_anno_obj['results'][0]['name'] == 'biological_process'
-    True
-    >>> go_anno_obj['results'][0]['aspect'] == 'biological_process'
-    True
+    pooled session, rate limiting, retries and response cache shared by
+    the REST clients. A `session` and `limiter` can be passed to share
+    them between clients, a passed session is not closed by the client.
     '''
 
-    def __init__(self, server='https://www.ebi.ac.uk', reqs_per_sec=15):
+    def __init__(self, server, reqs_per_sec=15,
+                 limit=DEFAULT_CONN_LIMIT,
+                 limit_per_host=DEFAULT_CONN_LIMIT_PER_HOST,
+                 ttl_dns_cache=DEFAULT_DNS_CACHE_TTL,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 limiter=None, max_retries=DEFAULT_MAX_RETRIES,
+                 cache=None, session=None):
         self.server = server
         self.reqs_per_sec = reqs_per_sec
-        self.req_count = 0
-        self.last_req = 0
+        if limiter is None:
+            limiter = RateLimiter(reqs_per_sec)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.cache = cache
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.session = session
+        self.own_session = session is None
+        self.new_conns = 0
+        self.reused_conns = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _on_conn_create(self, session, trace_ctx, params):
+        self.new_conns += 1
+
+    async def _on_conn_reuse(self, session, trace_ctx, params):
+        self.reused_conns += 1
+
+    async def open(self):
+        """
+        one session (and its keep-alive connection pool) is shared by all
+        requests of the client, it must be opened inside the event loop.
+        """
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(
+                self._on_conn_create)
+            trace_config.on_connection_reuseconn.append(self._on_conn_reuse)
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[trace_config])
+        return self.session
+
+    async def close(self):
+        if not self.own_session:
+            return
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    @property
+    def conn_stats(self):
+        return f'{self.new_conns} new connections, ' \
+            f'{self.reused_conns} reused connections'
+
+    async def perform_rest_action(self, endpoint, hdrs=None, params=None,
+                                  use_cache=True, post_data=None):
+        '''
+        GET `endpoint`, or POST `post_data` as json body if it is given,
+        POST responses are not cached.
+        '''
+        if post_data is not None:
+            use_cache = False
 
-    async def perform_rest_action(self, endpoint, hdrs=None, params=None):
         if hdrs is None:
             hdrs = {}
 
@@ -150,33 +400,43 @@ class UniprotClient(object):
             url = endpoint
 
         data = None
+        url = self.server + url
 
-        # check if we need to rate limit ourselves
-        if self.req_count >= self.reqs_per_sec:
-            delta = time.time() - self.last_req
-            if delta < 1:
-                await asyncio.sleep(1 - delta)
-            self.last_req = time.time()
-            self.req_count = 0
+        if use_cache and self.cache is not None:
+            data = self.cache.get(url, hdrs['Accept'])
+            if data is not None or self.cache.offline:
+                return data
 
-        requests.adapters.DEFAULT_RETRIES = 5
+        session = await self.open()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.server + url, headers=hdrs) as request:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire(url)
+                if post_data is None:
+                    request_ctx = session.get(url, headers=hdrs)
+                else:
+                    request_ctx = session.post(url, headers=hdrs,
+                                               json=post_data)
+                async with request_ctx as request:
                     if request.status == 200:
                         if hdrs['Accept'] == 'application/json':
                             data = await request.json()
                         elif 'text' in hdrs['Accept']:
                             data = await request.text()
-                    elif request.status_code == 429:
-                        # check if we are being rate limited by the server
-                        if 'Retry-After' in request.headers:
-                            retry = request.headers['Retry-After']
-                            time.sleep(float(retry))
-                            self.perform_rest_action(endpoint, hdrs, params)
+                        if use_cache and self.cache is not None:
+                            self.cache.set(url, data, hdrs['Accept'])
+                        break
+                    elif request.status in RETRY_STATUS:
+                        # rate limited by the server, the whole host
+                        # waits, not only this request
+                        delay = retry_after_delay(
+                            request.headers.get('Retry-After'), attempt)
+                        self.limiter.backoff(url, delay)
                     else:
                         request.raise_for_status()
-                    self.req_count += 1
+            else:
+                sys.stderr.write(
+                    f'Request failed for {endpoint}: still rate limited '
+                    f'after {self.max_retries} retries.\n')
         except (aiohttp.client_exceptions.ClientConnectorError,
                 asyncio.TimeoutError,
                 aiohttp.client_exceptions.ServerDisconnectedError,
@@ -190,6 +450,46 @@ class UniprotClient(object):
 
         return data
 
+    async def fetch_batched(self, batcher, item_id, item_url):
+        '''
+        batched lookups are cached per ID under `item_url`,
+        only IDs missing in the cache go into a batch.
+        '''
+        if self.cache is not None:
+            data = self.cache.get(self.server + item_url)
+            if data is not None or self.cache.offline:
+                return data
+        data = await batcher.get(item_id)
+        if data and self.cache is not None:
+            self.cache.set(self.server + item_url, data)
+        return data
+
+
+class UniprotClient(AsyncRestClient):
+    '''
+    class to use EMBL-EBI API to download protein & go annotation
+
+    >>> client = UniprotClient()
+
+    test download go annotation
+    >>> go_anno_obj = client.get_go_anno('GO:0008150')
+    >>> go_anno_obj['results'][0]['id'] == 'GO:0008150'
+    True
+    >>> go_anno_obj['results'][0]['name'] == 'biological_process'
+    True
+    >>> go_anno_obj['results'][0]['aspect'] == 'biological_process'
+    True
+    '''
+
+    def __init__(self, server='https://www.ebi.ac.uk', reqs_per_sec=15,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 batch_linger=DEFAULT_BATCH_LINGER, **kwargs):
+        super().__init__(server, reqs_per_sec, **kwargs)
+        self.protein_batcher = BatchRequester(
+            self.get_proteins_inf, batch_size, batch_linger)
+        self.go_term_batcher = BatchRequester(
+            self.get_go_terms, batch_size, batch_linger)
+
     async def get_gene_inf(self, gene_id):
         gene_obj = await self.perform_rest_action(
             f'/proteins/api/proteins/{gene_id}',
@@ -203,6 +503,35 @@ class UniprotClient(object):
         )
         return prot_obj
 
+    async def get_proteins_inf(self, uniprot_ids):
+        '''
+        entries of a list of accessions in one request,
+        as {accession: entry}, secondary accessions point to the
+        entry they were merged into.
+        '''
+        prot_objs = await self.perform_rest_action(
+            '/proteins/api/proteins',
+            params={'accession': ','.join(uniprot_ids),
+                    'size': -1},
+            use_cache=False
+        )
+        if prot_objs is None:
+            return None
+        prot_dict = dict()
+        for prot_obj in prot_objs:
+            for each_id in prot_obj.get('secondaryAccession', []):
+                prot_dict[each_id] = prot_obj
+            prot_dict[prot_obj['accession']] = prot_obj
+        return prot_dict
+
+    async def fetch_protein(self, uniprot_id):
+        '''
+        entry of an accession, batched with other pending lookups
+        '''
+        return await self.fetch_batched(
+            self.protein_batcher, uniprot_id,
+            f'/proteins/api/proteins/{uniprot_id}')
+
     async def get_go_inf(self, uniprot_id, page=1):
         go_obj = await self.perform_rest_action(
             '/QuickGO/services/annotation/search',
@@ -219,6 +548,93 @@ class UniprotClient(object):
         )
         return go_anno
 
+    async def get_go_terms(self, go_ids):
+        go_terms = await self.perform_rest_action(
+            '/QuickGO/services/ontology/go/terms/{gi}'.format(
+                gi=','.join(go_ids)),
+            use_cache=False
+        )
+        if go_terms is None:
+            return None
+        return {each['id']: each for each in go_terms.get('results', [])}
+
+    async def fetch_go_term(self, go_id):
+        '''
+        GO term information, batched with other pending lookups
+        '''
+        return await self.fetch_batched(
+            self.go_term_batcher, go_id,
+            f'/QuickGO/services/ontology/go/terms/{go_id}')
+
+
+class AsyncEnsemblClient(AsyncRestClient):
+    '''
+    asyncio client of Ensembl REST, sequence and lookup requests of
+    single IDs are batched into POST requests (up to 50 and 1000 IDs).
+    There are no POST endpoints for xrefs and homology, those are sent
+    one ID per GET and are only paced by the limiter.
+    '''
+
+    def __init__(self, server='http://rest.ensembl.org', reqs_per_sec=15,
+                 seq_type='genomic', batch_linger=DEFAULT_BATCH_LINGER,
+                 **kwargs):
+        super().__init__(server, reqs_per_sec, **kwargs)
+        self.seq_type = seq_type
+        self.seq_batcher = BatchRequester(
+            self.get_seqs, ENSEMBL_SEQ_POST_MAX, batch_linger)
+        self.lookup_batcher = BatchRequester(
+            self.get_lookups, ENSEMBL_LOOKUP_POST_MAX, batch_linger)
+
+    async def get_seqs(self, ens_ids):
+        '''
+        sequences of a list of IDs in one request, as {id: seq_obj}
+        '''
+        seq_objs = await self.perform_rest_action(
+            '/sequence/id',
+            post_data={'ids': ens_ids, 'type': self.seq_type})
+        if seq_objs is None:
+            return None
+        return {each['query']: each for each in seq_objs}
+
+    async def fetch_seq(self, ens_id):
+        '''
+        sequence of an ID, batched with other pending lookups
+        '''
+        return await self.fetch_batched(
+            self.seq_batcher, ens_id,
+            f'/sequence/id/{ens_id}?type={self.seq_type}')
+
+    async def get_lookups(self, ens_ids):
+        lookup_objs = await self.perform_rest_action(
+            '/lookup/id', post_data={'ids': ens_ids})
+        if lookup_objs is None:
+            return None
+        return {key: val for key, val in lookup_objs.items()
+                if val is not None}
+
+    async def fetch_lookup(self, ens_id):
+        '''
+        feature information of an ID, batched with other pending lookups
+        '''
+        return await self.fetch_batched(
+            self.lookup_batcher, ens_id, f'/lookup/id/{ens_id}')
+
+    async def get_xrefs(self, ens_id, external_db=None):
+        params = None
+        if external_db is not None:
+            params = {'external_db': external_db}
+        return await self.perform_rest_action(
+            f'/xrefs/id/{ens_id}', params=params)
+
+    async def get_uniprot_id(self, ens_id):
+        return await self.get_xrefs(ens_id, external_db='Uniprot_gn')
+
+    async def get_orthologues(self, ens_id, taxon=4565):
+        return await self.perform_rest_action(
+            f'/homology/id/{ens_id}',
+            params={'type': 'orthologues',
+                    'target_taxon': taxon})
+
 
 def run(species, symbol):
     client = EnsemblRestClient()
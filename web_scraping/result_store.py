@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+import asyncio
+import pandas as pd
+from pathlib import Path
+
+
+DEFAULT_WRITE_BATCH = 500
+DEFAULT_QUEUE_SIZE = 1000
+
+
+class ResultStore(object):
+    '''
+    downloaded tables of all query IDs in one SQLite file (WAL mode),
+    one row per ID, so resuming is a primary key lookup instead of
+    reading back a file per ID.
+
+    results are queued by `put` and written in batches by a single
+    writer task, the bounded queue makes producers wait when the
+    writer falls behind.
+    '''
+
+    def __init__(self, store_file, write_batch=DEFAULT_WRITE_BATCH,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self.store_file = Path(store_file)
+        self.write_batch = write_batch
+        self.queue_size = queue_size
+        self.queue = None
+        self.writer_task = None
+        self.conn = sqlite3.connect(str(self.store_file))
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                          'item_id TEXT PRIMARY KEY, records TEXT)')
+        self.conn.commit()
+
+    def finished_ids(self):
+        return {each[0] for each in
+                self.conn.execute('SELECT item_id FROM results')}
+
+    def left_ids(self, query_ids):
+        finished_ids = self.finished_ids()
+        return [each for each in query_ids if each not in finished_ids]
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.writer_task = asyncio.ensure_future(self._write())
+
+    async def put(self, item_id, result):
+        '''
+        result of an ID, a DataFrame or a list of record dicts
+        '''
+        if isinstance(result, pd.DataFrame):
+            records = result.to_json(orient='records')
+        else:
+            records = json.dumps(result)
+        await self.queue.put((item_id, records))
+
+    async def _write(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.write_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            rows = [each for each in batch if each is not None]
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?)', rows)
+            self.conn.commit()
+            if len(rows) < len(batch):
+                return
+
+    async def stop(self):
+        '''
+        flush queued results and wait for the writer to finish
+        '''
+        await self.queue.put(None)
+        await self.writer_task
+
+    def to_df(self):
+        records = []
+        for each in self.conn.execute('SELECT records FROM results'):
+            records.extend(json.loads(each[0]))
+        return pd.DataFrame(records)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,18 @@
+from download_blastdb import MIN_SEGMENT_SIZE, plan_segments
+
+
+def test_plan_segments_empty_file():
+    assert plan_segments(0, 4) == [[0, 0, 0]]
+
+
+def test_plan_segments_cover_file():
+    size = MIN_SEGMENT_SIZE * 4 + 1
+    seg_list = plan_segments(size, 4)
+    assert len(seg_list) == 4
+    assert seg_list[0][0] == 0 and seg_list[-1][1] == size
+    for prev_seg, seg in zip(seg_list, seg_list[1:]):
+        assert prev_seg[1] == seg[0] == seg[2]
+
+
+def test_plan_segments_small_file():
+    assert plan_segments(10, 4) == [[0, 10, 0]]
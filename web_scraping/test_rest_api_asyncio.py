@@ -0,0 +1,38 @@
+import asyncio
+import pytest
+from rest_api_asyncio import TokenBucket, BatchRequester
+
+
+def test_token_bucket_rate_below_one():
+    bucket = TokenBucket(0.5)
+    assert bucket.capacity == 1
+
+    async def acquire_twice():
+        # the first token is there at once, the next one after 2s
+        await asyncio.wait_for(bucket.acquire(), 1)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(bucket.acquire(), 0.5)
+
+    asyncio.run(acquire_twice())
+    assert bucket.acquired == 1
+
+
+def test_batch_requester_cancelled_caller():
+    async def fetch_batch(ids):
+        await asyncio.sleep(0.1)
+        return {each: each.upper() for each in ids}
+
+    async def get_three():
+        batcher = BatchRequester(fetch_batch, batch_size=3, linger=0.01)
+        tasks = [asyncio.ensure_future(batcher.get(each))
+                 for each in ('a', 'b', 'c')]
+        await asyncio.sleep(0.05)
+        tasks[0].cancel()
+        results = await asyncio.wait_for(
+            asyncio.gather(*tasks, return_exceptions=True), 1)
+        assert not batcher.tasks
+        return results
+
+    results = asyncio.run(get_three())
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1:] == ['B', 'C']